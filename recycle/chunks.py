@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+from pathlib import Path
+import tempfile
+import threading
+import zlib
+
+from recycle.compression import detect
+from recycle.manifest import manifest_name
+from recycle.manifest import read_manifest
+from recycle.manifest import write_manifest
+from recycle.providers import gcs
+from recycle.providers.mongo import raw_bson_iter
+
+min_size = 64 << 10
+max_size = 8 << 20
+# a record ends a chunk once in 1024 on average
+boundary_mask = 0x3FF
+block_size = 1 << 20
+
+
+def records(inp, file):
+    if detect(file).codec != "none":
+        # compressed streams do not share content, fixed blocks will do
+        return iter(lambda: inp.read(block_size), b"")
+    if ".bson" in Path(file).name:
+        return raw_bson_iter(inp)
+    return inp
+
+
+def chunk_file(file):
+    """
+    Splits a file into content defined chunks, cut after the records whose
+    crc32 matches the boundary mask. Inserting or removing records only
+    changes the chunks around them.
+    """
+    with open(file, "rb") as inp:
+        chunk = []
+        size = 0
+        for record in records(inp, file):
+            chunk.append(record)
+            size += len(record)
+            if size >= max_size or (
+                size >= min_size and zlib.crc32(record) & boundary_mask == 0
+            ):
+                yield b"".join(chunk)
+                chunk = []
+                size = 0
+        if len(chunk):
+            yield b"".join(chunk)
+
+
+def chunk_name(digest):
+    return f"chunks/{digest[:2]}/{digest}"
+
+
+def write_chunk(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(zlib.compress(data))
+    os.replace(tmp_path, path)
+
+
+def pack(folder, store, threads=4):
+    """
+    Moves the files of folder into a content addressed chunk store, a local
+    folder or a gs:// uri, only the chunks missing from it are written. The
+    manifest lists the chunks of each file.
+    """
+    files = [
+        p for p in Path(folder).glob("**/*") if p.is_file() and p.name != manifest_name
+    ]
+    remote = store.startswith("gs://")
+
+    existing = set()
+    if remote:
+        _, prefix = gcs.parse(store)
+        existing = {
+            b.name[len(prefix) :].lstrip("/") for b in gcs.blobs(f"{store}/chunks")
+        }
+
+    with tempfile.TemporaryDirectory(dir=".") as staging:
+        root = Path(staging if remote else store)
+        written = []
+
+        def pack_file(file):
+            digests = []
+            for chunk in chunk_file(file):
+                digest = hashlib.sha256(chunk).hexdigest()
+                digests.append(digest)
+                name = chunk_name(digest)
+                if name not in existing and not (root / name).exists():
+                    write_chunk(root / name, chunk)
+                    written.append(len(chunk))
+            return file.relative_to(folder).as_posix(), digests
+
+        with ThreadPoolExecutor(threads) as pool:
+            packed = dict(pool.map(pack_file, files))
+
+        if remote:
+            gcs.push(store, staging)
+
+    n_chunks = sum(len(digests) for digests in packed.values())
+    logging.info(
+        f"packed {len(files)} files in {n_chunks} chunks, {len(written)} new ({sum(written)} bytes)"
+    )
+
+    # layers of incremental snapshots keep the chunks of the previous ones
+    previous = read_manifest(folder).get("chunks", {}).get("files", {})
+    write_manifest(folder, chunks=dict(store=store, files=dict(previous, **packed)))
+
+    for file in files:
+        os.remove(file)
+    for path in sorted(Path(folder).glob("**/*"), reverse=True):
+        if path.is_dir() and not any(path.iterdir()):
+            path.rmdir()
+
+
+def unpack(folder, cache=None, threads=4):
+    """
+    Rebuilds the files of the chunked snapshots found under folder, chunks
+    of remote stores are fetched into cache unless already there.
+    """
+    snapshots = [
+        path.parent
+        for path in Path(folder).glob(f"**/{manifest_name}")
+        if "chunks" in read_manifest(path.parent)
+    ]
+
+    for snapshot in snapshots:
+        manifest = read_manifest(snapshot)
+        chunks = manifest.pop("chunks")
+        store = chunks["store"]
+
+        with tempfile.TemporaryDirectory(dir=".") as staging:
+            root = Path(store)
+            if store.startswith("gs://"):
+                root = Path(cache if cache is not None else staging)
+                missing = {
+                    chunk_name(digest)
+                    for digests in chunks["files"].values()
+                    for digest in digests
+                    if not (root / chunk_name(digest)).exists()
+                }
+                logging.info(f"fetching {len(missing)} chunks from {store}")
+                gcs.fetch(store, sorted(missing), root)
+
+            def unpack_file(item):
+                name, digests = item
+                file = snapshot / name
+                file.parent.mkdir(parents=True, exist_ok=True)
+                with open(file, "wb") as out:
+                    for digest in digests:
+                        with open(root / chunk_name(digest), "rb") as inp:
+                            chunk = zlib.decompress(inp.read())
+                        assert (
+                            hashlib.sha256(chunk).hexdigest() == digest
+                        ), f"chunk {digest} is corrupted"
+                        out.write(chunk)
+
+            with ThreadPoolExecutor(threads) as pool:
+                for _ in pool.map(unpack_file, chunks["files"].items()):
+                    pass
+
+        logging.info(f"unpacked {len(chunks['files'])} files into {snapshot}")
+        os.remove(snapshot / manifest_name)
+        write_manifest(snapshot, **manifest)
@@ -0,0 +1,167 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import gzip
+import io
+import logging
+import os
+from pathlib import Path
+import shutil
+from typing import Optional
+
+codecs = ["none", "gzip", "zstd"]
+extensions = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+@dataclass
+class Compression:
+    codec: str = "gzip"
+    level: Optional[int] = None
+
+    @property
+    def extension(self):
+        return extensions[self.codec]
+
+
+def parse_compression(spec):
+    codec, _, level = spec.partition(":")
+    assert codec in codecs, f"unknown compression {codec}, expected one of {codecs}"
+    if codec == "gzip" and level:
+        assert 1 <= int(level) <= 9, "gzip level must be between 1 and 9"
+    return Compression(codec, int(level) if level else None)
+
+
+def detect(file):
+    for codec, extension in extensions.items():
+        if extension and str(file).endswith(extension):
+            return Compression(codec)
+    return Compression("none")
+
+
+def strip_extension(file):
+    extension = detect(file).extension
+    return str(file)[: -len(extension)] if extension else str(file)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Compresses fixed size blocks in a thread pool and writes them as members
+    of a multi-member gzip file, which gzip readers read back as one stream.
+    """
+
+    def __init__(self, fileobj, level=6, threads=1, block_size=1 << 20):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self.submit()
+        return len(data)
+
+    def submit(self):
+        block = bytes(self.buffer)
+        self.buffer.clear()
+        self.pending.append(self.pool.submit(gzip.compress, block, self.level))
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        if len(self.buffer) or not self.pending:
+            self.submit()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.fileobj.close()
+        super().close()
+
+
+def zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the zstandard package")
+    return zstandard
+
+
+def open_file(file, mode="rb", compression=None, threads=1):
+    """
+    Opens a file for reading or writing, the codec is detected from the file
+    extension unless a compression is given for writing.
+    """
+    compression = compression or detect(file)
+    text = "t" in mode
+    mode = mode.replace("t", "").replace("b", "")
+
+    if compression.codec == "none":
+        fileobj = open(file, f"{mode}b")
+    elif compression.codec == "gzip" and mode == "r":
+        fileobj = gzip.open(file, "rb")
+    elif compression.codec == "gzip" and threads > 1:
+        fileobj = io.BufferedWriter(
+            ParallelGzipWriter(
+                open(file, "wb"), level=compression.level or 6, threads=threads
+            )
+        )
+    elif compression.codec == "gzip":
+        fileobj = gzip.open(file, "wb", compresslevel=compression.level or 6)
+    elif mode == "r":
+        fileobj = (
+            zstandard()
+            .ZstdDecompressor()
+            .stream_reader(open(file, "rb"), read_across_frames=True)
+        )
+        fileobj = io.BufferedReader(fileobj)
+    else:
+        compressor = zstandard().ZstdCompressor(
+            level=compression.level or 3, threads=threads
+        )
+        fileobj = compressor.stream_writer(open(file, "wb"))
+
+    return io.TextIOWrapper(fileobj, encoding="utf-8") if text else fileobj
+
+
+def compress_tree(folder, compression, threads=1, exclude=("manifest.json",)):
+    if compression.codec == "none":
+        return
+
+    files = [
+        p
+        for p in Path(folder).glob("**/*")
+        if p.is_file() and detect(p).codec == "none" and p.name not in exclude
+    ]
+    files.sort(key=lambda p: p.stat().st_size, reverse=True)
+
+    for file in files:
+        logging.info(f"compressing {file} with {compression.codec}")
+        with open(file, "rb") as inp:
+            with open_file(
+                f"{file}{compression.extension}", "wb", compression, threads
+            ) as out:
+                shutil.copyfileobj(inp, out, 1 << 20)
+        os.remove(file)
+
+
+def decompress_tree(folder, exclude=("manifest.json",)):
+    files = [
+        p
+        for p in Path(folder).glob("**/*")
+        if p.is_file() and detect(p).codec != "none" and p.name not in exclude
+    ]
+
+    for file in files:
+        logging.info(f"decompressing {file}")
+        with open_file(file, "rb") as inp:
+            with open(strip_extension(file), "wb") as out:
+                shutil.copyfileobj(inp, out, 1 << 20)
+        os.remove(file)
@@ -13,11 +13,57 @@ class Transform:
     keep: Optional[relativedelta]
     drop: Optional[bool]
     anonymize: Dict[str, Union[str, List[str]]] = field(default_factory=dict)
+    deterministic: Optional[bool] = None
+    # column keep is applied to, tables have no ObjectId to date their rows
+    timestamp: Optional[str] = None
+    # sql predicate rows are dumped by
+    where: Optional[str] = None
 
 
 Transforms = Dict[str, Dict[str, Transform]]
 
 
+@dataclass
+class Pool:
+    size: int = 10_000
+    seed: Optional[int] = None
+
+
+@dataclass
+class Mapping:
+    key: str
+    store: Optional[str] = None
+    cache_size: int = 100_000
+
+
 @dataclass
 class Ops:
     transforms: Transforms
+    pool: Optional[Pool] = None
+    mapping: Optional[Mapping] = None
+
+
+@dataclass
+class Run:
+    command: str
+    source: str
+    sink: str
+    transform: Optional[str] = None
+    collection: Optional[str] = None
+    table: Optional[str] = None
+    jobs: Optional[int] = None
+    keep_previous: bool = False
+    stream: bool = False
+    fast_load: bool = False
+    json: bool = False
+    ndjson: bool = False
+    incremental: bool = False
+    compression: Optional[str] = None
+    chunk_store: Optional[str] = None
+
+
+@dataclass
+class Batch:
+    runs: List[Run]
+    jobs: int = 16
+    parallel: Optional[int] = None
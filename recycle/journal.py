@@ -0,0 +1,62 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+journal_path = ".recycle-journal.jsonl"
+
+
+class Journal:
+    """
+    Append-only record of the stages completed by a run, so that a resumed
+    run with the same arguments can skip them. Lines are appended with a
+    single write, which keeps them whole when worker processes mark stages
+    concurrently.
+    """
+
+    def __init__(self, path=journal_path, run=None, resume=False):
+        # absolute, workers marking stages may run in another directory
+        self.path = Path(path).absolute()
+        # runs are identified by a digest, their uris hold credentials
+        self.run = hashlib.sha256(
+            json.dumps(run or {}, sort_keys=True).encode()
+        ).hexdigest()
+        self.entries = {}
+
+        if resume and self.path.exists():
+            with open(self.path) as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+
+            if len(lines) and lines[0].get("run") == self.run:
+                for entry in lines[1:]:
+                    self.entries[(entry["stage"], entry["key"])] = entry
+                logging.info(f"resuming from {len(self.entries)} journal entries")
+                return
+
+            logging.warning(f"{self.path} belongs to another run, starting over")
+
+        with open(self.path, "w") as f:
+            f.write(json.dumps(dict(run=self.run)) + "\n")
+
+    def done(self, stage, key=""):
+        return (stage, key) in self.entries
+
+    def get(self, stage, key=""):
+        return self.entries.get((stage, key))
+
+    def mark(self, stage, key="", **data):
+        entry = dict(data, stage=stage, key=key)
+        self.entries[(stage, key)] = entry
+
+        line = (json.dumps(entry) + "\n").encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def clear(self):
+        if self.path.exists():
+            os.remove(self.path)
@@ -1,10 +1,25 @@
+from datetime import datetime
+from datetime import timezone
 import logging
+import os
 from pathlib import Path
+from time import time
 from typing import Optional
 
 import dataconf
 from furl import furl
+from joblib import delayed
+from joblib import Parallel
+from recycle import chunks
 from recycle import config
+from recycle import staging
+from recycle.compression import compress_tree
+from recycle.compression import decompress_tree
+from recycle.compression import parse_compression
+from recycle.journal import Journal
+from recycle.manifest import manifest_name
+from recycle.manifest import read_manifest
+from recycle.manifest import write_manifest
 from recycle.providers import gcs
 from recycle.providers import mongo as mongodb
 from recycle.providers import postgres as postgresql
@@ -26,6 +41,14 @@ def mongo(
     jobs: int = Option(4),
     keep_previous: bool = Option(False),
     json: bool = Option(False),
+    ndjson: bool = Option(False),
+    stream: bool = Option(False),
+    follow: bool = Option(False),
+    incremental: bool = Option(False),
+    compression: Optional[str] = Option(None),
+    resume: bool = Option(False),
+    cache: Optional[str] = Option(None, envvar="RECYCLE_CACHE"),
+    chunk_store: Optional[str] = Option(None),
     verbose: bool = Option(False),
 ):
     try:
@@ -34,13 +57,18 @@ def mongo(
         source_folder = str(source_uri.path).lstrip("/")
         sink_folder = str(sink_uri.path).lstrip("/")
         db_name = ""
+        json = json or ndjson
+        compression = parse_compression(compression) if compression else None
 
+        # the snapshot is the content of the database folder of the source
+        source_root = source_folder
         if source_uri.scheme == "mongodb" or source_uri.scheme == "mongodb+srv":
             source_folder = "dump"
+            source_root = f"{source_folder}/{source_root}"
         if source_uri.scheme == "gs":
             db_name = source_folder.split("/")[0]
             source_folder = "gcs"
-            shell(f"mkdir -p {source_folder}")
+            source_root = f"{source_folder}/{db_name}"
 
         if sink_uri.scheme == "mongodb" or sink_uri.scheme == "mongodb+srv":
             sink_folder = f"dump/{sink_folder}"
@@ -48,6 +76,64 @@ def mongo(
         logging.info(f"source folder: {source_folder}")
         logging.info(f"sink folder: {sink_folder}")
 
+        ops = None
+        if transform is not None:
+            loader = dataconf.load if Path(transform).exists() else dataconf.loads
+            ops = loader(transform, config.Ops)
+
+        start_at = None
+        if follow:
+            if not {source_uri.scheme, sink_uri.scheme} <= {"mongodb", "mongodb+srv"}:
+                echo("follow requires a mongodb source and sink")
+                raise Exit(-1)
+
+            token_path = mongodb.resume_token_path(
+                source_uri.url, sink_uri.url, collection
+            )
+            if mongodb.read_resume_token(token_path) is not None:
+                logging.info("resume token found, skipping the initial copy")
+                mongodb.follow(source_uri.url, sink_uri.url, ops, collection)
+                return
+
+            # changes made during the initial copy are replayed afterwards
+            start_at = mongodb.cluster_time(source_uri.url)
+
+        if stream:
+            if not {source_uri.scheme, sink_uri.scheme} <= {"mongodb", "mongodb+srv"}:
+                echo("stream requires a mongodb source and sink")
+                raise Exit(-1)
+
+            mongodb.stream_cli(
+                source_uri.url,
+                sink_uri.url,
+                collection,
+                n_parallel=jobs,
+                keep_previous=keep_previous,
+                ops=ops,
+            )
+            if follow:
+                mongodb.follow(
+                    source_uri.url, sink_uri.url, ops, collection, start_at=start_at
+                )
+            return
+
+        journal = Journal(
+            run=dict(
+                command="mongo",
+                source=source,
+                sink=sink,
+                transform=transform,
+                collection=collection,
+                json=json,
+                incremental=incremental,
+                compression=compression and compression.codec,
+                chunk_store=chunk_store,
+            ),
+            resume=resume,
+        )
+        # a resumed run finds the folders as the previous run left them
+        resuming = bool(journal.entries)
+
         if (
             source_uri.scheme not in ["gs", "mongodb", "mongodb+srv"]
             and not Path(source_folder).is_dir()
@@ -57,18 +143,73 @@ def mongo(
 
         if (
             sink_uri.scheme not in ["gs", "mongodb", "mongodb+srv"]
+            and not resuming
+            and not incremental
             and Path(sink_folder).exists()
             and any(Path(sink_folder).iterdir())
         ):
             echo(f"sink {sink_uri} must be an empty directory")
             raise Exit(-1)
 
-        if source_uri.scheme == "gs":
-            gcs.pull(source_uri.url, folder=source_folder)
-            shell(f"mkdir -p {source_folder}/{db_name}")
-            shell(
-                f"find {source_folder} -type f -exec mv {'{}'} {source_folder}/{db_name} ;"
-            )
+        if incremental and (
+            source_uri.scheme not in ["mongodb", "mongodb+srv"]
+            or sink_uri.scheme in ["mongodb", "mongodb+srv"]
+            or json
+        ):
+            echo("incremental requires a mongodb source, a snapshot sink and bson")
+            raise Exit(-1)
+
+        if chunk_store is not None and sink_uri.scheme in ["mongodb", "mongodb+srv"]:
+            echo("chunk store requires a snapshot sink")
+            raise Exit(-1)
+
+        if chunk_store is not None and (
+            compression is None or compression.codec != "none"
+        ):
+            # compressed files share no content, their chunks never dedupe
+            echo("chunk store requires --compression none")
+            raise Exit(-1)
+
+        layer = None
+        watermarks = None
+        if incremental and not journal.done("staged"):
+            # the snapshot manifest lists its layers and the _id watermarks
+            # the next delta starts from
+            if sink_uri.scheme == "gs" and gcs.exists(
+                f"{sink_uri.url}/{manifest_name}"
+            ):
+                gcs.pull(f"{sink_uri.url}/{manifest_name}", folder=sink_folder)
+            previous = read_manifest(sink_folder)
+
+            codec = compression.codec if compression is not None else "gzip"
+            assert (
+                previous.get("compression", codec) == codec
+            ), f"snapshot layers are compressed with {previous['compression']}"
+
+            dumped = journal.get("dumped")
+            if dumped is not None:
+                layer = dumped["layer"]
+                watermarks = dumped["watermarks"]
+            else:
+                now = datetime.now(tz=timezone.utc)
+                layer = "base"
+                if previous.get("layers"):
+                    layer = f"delta-{now:%Y%m%dT%H%M%SZ}"
+                watermarks = mongodb.dump_watermarks(
+                    source_uri.url, collection, previous.get("watermarks")
+                )
+
+        if journal.done("staged"):
+            logging.info("source already dumped, transformed and staged")
+
+        elif journal.done("dumped"):
+            logging.info("source already dumped")
+
+        elif source_uri.scheme == "gs":
+            gcs.pull(source_uri.url, folder=source_root, cache=cache)
+            chunks.unpack(source_root, cache=cache, threads=jobs)
+            mongodb.merge_layers(source_root)
+            journal.mark("dumped")
 
         elif source_uri.scheme == "mongodb" or source_uri.scheme == "mongodb+srv":
             mongodb.dump_cli(
@@ -77,31 +218,90 @@ def mongo(
                 folder=source_folder,
                 n_parallel=jobs,
                 jsonarray=json,
+                ndjson=ndjson,
+                ops=ops,
+                gzip=compression is None,
+                watermarks=watermarks,
             )
+            journal.mark("dumped", layer=layer, watermarks=watermarks)
 
-        if transform is not None:
-            logging.info("Starting transform")
-            loader = dataconf.load if Path(transform).exists() else dataconf.loads
-            ops = loader(transform, config.Ops)
-            mongodb.transform(ops, source_folder, verbose=verbose, jsonarray=json)
+        else:
+            chunks.unpack(source_folder, cache=cache, threads=jobs)
+            mongodb.merge_layers(source_folder)
 
-        shell(f"mkdir -p {sink_folder}")
-        shell(f"find {source_folder} -type f -exec mv {'{}'} {sink_folder} ;")
+        if ops is not None and not journal.done("staged"):
+            logging.info("Starting transform")
+            mongodb.transform(
+                ops,
+                source_folder,
+                verbose=verbose,
+                jsonarray=json,
+                ndjson=ndjson,
+                n_jobs=jobs,
+                journal=journal,
+            )
 
-        if sink_uri.scheme == "gs":
+        if not journal.done("staged"):
+            if compression is not None and source_uri.scheme in [
+                "mongodb",
+                "mongodb+srv",
+            ]:
+                if sink_uri.scheme in ["mongodb", "mongodb+srv"]:
+                    # restored right away, no point compressing
+                    compression = parse_compression("none")
+                compress_tree(source_folder, compression, threads=jobs)
+                write_manifest(source_root, compression=compression.codec)
+
+            if layer is not None:
+                staging.move_tree(source_root, f"{sink_folder}/{layer}")
+                mongodb.write_layer(sink_folder, layer, watermarks, codec)
+            else:
+                staging.move_tree(source_root, sink_folder)
+            if chunk_store is not None:
+                chunks.pack(sink_folder, chunk_store, threads=jobs)
+            journal.mark("staged")
+
+        if sink_uri.scheme == "gs" and not journal.done("pushed"):
             gcs.push(sink_uri.url, folder=sink_folder)
-
-        elif sink_uri.scheme == "mongodb" or sink_uri.scheme == "mongodb+srv":
-            mongodb.restore_cli(
-                sink_uri.url,
-                collection,
-                folder="dump",
-                n_parallel=jobs,
-                keep_previous=keep_previous,
-            )
+            journal.mark("pushed")
+
+        elif (
+            sink_uri.scheme == "mongodb" or sink_uri.scheme == "mongodb+srv"
+        ) and not journal.done("restored"):
+            codec = read_manifest(sink_folder).get("compression", "gzip")
+            if codec == "zstd":
+                decompress_tree(sink_folder)
+            if resume:
+                # restored from the last acknowledged offset of each collection
+                mongodb.restore_py(
+                    sink_uri.url,
+                    collection,
+                    folder="dump",
+                    n_parallel=jobs,
+                    keep_previous=keep_previous,
+                    journal=journal,
+                    gzip=codec == "gzip",
+                )
+            else:
+                mongodb.restore_cli(
+                    sink_uri.url,
+                    collection,
+                    folder="dump",
+                    n_parallel=jobs,
+                    keep_previous=keep_previous,
+                    gzip=codec == "gzip",
+                )
+            journal.mark("restored")
 
         if sink_folder != source_folder:
-            shell(f"rm -rf {source_folder}")
+            staging.remove_tree(source_folder)
+
+        journal.clear()
+
+        if follow:
+            mongodb.follow(
+                source_uri.url, sink_uri.url, ops, collection, start_at=start_at
+            )
 
     except Exit as e:
         raise e
@@ -120,6 +320,12 @@ def postgres(
     table: Optional[str] = Option(None),
     jobs: int = Option(4),
     keep_previous: bool = Option(False),
+    stream: bool = Option(False),
+    fast_load: bool = Option(False),
+    compression: Optional[str] = Option(None),
+    resume: bool = Option(False),
+    cache: Optional[str] = Option(None, envvar="RECYCLE_CACHE"),
+    chunk_store: Optional[str] = Option(None),
     verbose: bool = Option(False),
 ):
     try:
@@ -127,6 +333,45 @@ def postgres(
         sink_uri = furl(sink)
         source_folder = str(source_uri.path).lstrip("/")
         sink_folder = str(sink_uri.path).lstrip("/")
+        compression = parse_compression(compression) if compression else None
+
+        ops = None
+        if transform is not None:
+            loader = dataconf.load if Path(transform).exists() else dataconf.loads
+            ops = loader(transform, config.Ops)
+
+        if stream:
+            if source_uri.scheme != "postgresql" or sink_uri.scheme != "postgresql":
+                echo("stream requires a postgresql source and sink")
+                raise Exit(-1)
+
+            postgresql.stream_cli(
+                source_uri.url,
+                sink_uri.url,
+                table,
+                n_parallel=jobs,
+                keep_previous=keep_previous,
+                ops=ops,
+            )
+            return
+
+        journal = Journal(
+            run=dict(
+                command="postgres",
+                source=source,
+                sink=sink,
+                transform=transform,
+                table=table,
+                compression=compression and compression.codec,
+                chunk_store=chunk_store,
+            ),
+            resume=resume,
+        )
+        # a resumed run finds the folders as the previous run left them
+        resuming = bool(journal.entries)
+        if compression is not None and sink_uri.scheme == "postgresql":
+            # restored right away, no point compressing
+            compression = parse_compression("none")
 
         logging.info(f"source folder: {source_folder}")
         logging.info(f"sink folder: {sink_folder}")
@@ -140,40 +385,99 @@ def postgres(
 
         if (
             sink_uri.scheme not in ["gs", "postgresql"]
+            and not resuming
             and Path(sink_folder).exists()
             and any(Path(sink_folder).iterdir())
         ):
             echo(f"sink {source_uri} must be an empty directory")
             raise Exit(-1)
 
-        if source_uri.scheme == "gs":
-            gcs.pull(source_uri.url, folder=source_folder)
+        if chunk_store is not None and sink_uri.scheme == "postgresql":
+            echo("chunk store requires a snapshot sink")
+            raise Exit(-1)
+
+        if chunk_store is not None and (
+            compression is None or compression.codec != "none"
+        ):
+            # compressed files share no content, their chunks never dedupe
+            echo("chunk store requires --compression none")
+            raise Exit(-1)
+
+        if journal.done("staged"):
+            logging.info("source already dumped and staged")
+
+        elif journal.done("dumped"):
+            logging.info("source already dumped")
+
+        elif source_uri.scheme == "gs":
+            gcs.pull(source_uri.url, folder=source_folder, cache=cache)
+            chunks.unpack(source_folder, cache=cache, threads=jobs)
+            journal.mark("dumped")
 
         elif source_uri.scheme == "postgresql":
+            if resuming:
+                # pg_dump refuses to write into a non empty directory
+                staging.remove_tree(source_folder)
             postgresql.dump_cli(
-                source_uri.url, table, folder=source_folder, n_parallel=jobs
+                source_uri.url,
+                table,
+                folder=source_folder,
+                n_parallel=jobs,
+                compression=compression,
+                ops=ops,
             )
+            journal.mark("dumped")
 
-        if transform is not None:
-            raise NotImplementedError
+        else:
+            chunks.unpack(source_folder, cache=cache, threads=jobs)
 
-        shell(f"mkdir -p {sink_folder}")
-        shell(f"find {source_folder} -type f -exec mv {'{}'} {sink_folder} ;")
+        if ops is not None and not journal.done("staged"):
+            logging.info("Starting transform")
+            postgresql.transform(
+                ops,
+                source_folder,
+                verbose=verbose,
+                n_jobs=jobs,
+                journal=journal,
+            )
 
-        if sink_uri.scheme == "gs":
+        if not journal.done("staged"):
+            if compression is not None and source_uri.scheme == "postgresql":
+                if compression.codec == "zstd":
+                    compress_tree(
+                        source_folder,
+                        compression,
+                        threads=jobs,
+                        exclude=("manifest.json", "toc.dat"),
+                    )
+                write_manifest(source_folder, compression=compression.codec)
+
+            staging.move_tree(source_folder, sink_folder)
+            if chunk_store is not None:
+                chunks.pack(sink_folder, chunk_store, threads=jobs)
+            journal.mark("staged")
+
+        if sink_uri.scheme == "gs" and not journal.done("pushed"):
             gcs.push(sink_uri.url, folder=sink_folder)
+            journal.mark("pushed")
 
-        elif sink_uri.scheme == "postgresql":
+        elif sink_uri.scheme == "postgresql" and not journal.done("restored"):
+            if read_manifest(sink_folder).get("compression") == "zstd":
+                decompress_tree(sink_folder)
             postgresql.restore_cli(
                 sink_uri.url,
                 table,
                 folder=sink_folder,
                 n_parallel=jobs,
                 keep_previous=keep_previous,
+                fast=fast_load,
             )
+            journal.mark("restored")
 
         if sink_folder != source_folder:
-            shell(f"rm -rf {source_folder}")
+            staging.remove_tree(source_folder)
+
+        journal.clear()
 
     except Exit as e:
         raise e
@@ -184,13 +488,100 @@ def postgres(
         raise Exit(1)
 
 
+def batch_run(args, workdir):
+    # runs stage in folders relative to the working directory, one per run
+    origin = os.getcwd()
+    Path(workdir).mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+    start = time()
+    try:
+        code = cli(args, standalone_mode=False)
+    except Exit as e:
+        code = e.exit_code
+    finally:
+        os.chdir(origin)
+    logging.info(f"{args[0]} run {workdir} done in {round(time() - start)}s")
+    if not code:
+        # failed runs keep their journal for --resume
+        staging.remove_tree(workdir)
+    return code or 0
+
+
+@cli.command()
+def batch(
+    runs: str,
+    jobs: Optional[int] = Option(None),
+    parallel: Optional[int] = Option(None),
+    resume: bool = Option(False),
+    cache: Optional[str] = Option(None, envvar="RECYCLE_CACHE"),
+    workdir: str = Option(".recycle-batch"),
+):
+    """
+    Runs the source to sink copies listed in a hocon file concurrently, the
+    jobs budget is shared between the runs.
+    """
+    loader = dataconf.load if Path(runs).exists() else dataconf.loads
+    conf = loader(runs, config.Batch)
+    jobs = jobs or conf.jobs
+    parallel = max(1, min(parallel or conf.parallel or jobs, len(conf.runs)))
+
+    def local(path, relative):
+        if furl(path).scheme is not None or not path:
+            return path
+        if relative:
+            # the pipeline strips leading slashes, local paths stay relative
+            return os.path.relpath(os.path.abspath(path), relative)
+        return os.path.abspath(path) if Path(path).exists() else path
+
+    tasks = []
+    for i, run in enumerate(conf.runs):
+        assert run.command in ["mongo", "postgres"], f"unknown command {run.command}"
+        folder = os.path.abspath(f"{workdir}/{i}")
+        args = [
+            run.command,
+            local(run.source, folder),
+            local(run.sink, folder),
+            "--jobs",
+            str(run.jobs or max(1, jobs // parallel)),
+        ]
+        for name in ["transform", "chunk_store"]:
+            if getattr(run, name) is not None:
+                args += [f"--{name.replace('_', '-')}", local(getattr(run, name), None)]
+        for name in ["collection", "table", "compression"]:
+            if getattr(run, name) is not None:
+                args += [f"--{name}", getattr(run, name)]
+        for name in [
+            "keep_previous",
+            "stream",
+            "fast_load",
+            "json",
+            "ndjson",
+            "incremental",
+        ]:
+            if getattr(run, name):
+                args.append(f"--{name.replace('_', '-')}")
+        if resume:
+            args.append("--resume")
+        if cache is not None:
+            args += ["--cache", os.path.abspath(cache)]
+        tasks.append(delayed(batch_run)(args, folder))
+
+    # workers are reused between runs, and so are their connections
+    codes = Parallel(n_jobs=parallel)(tasks)
+
+    failed = [run.source for run, code in zip(conf.runs, codes) if code != 0]
+    for source in failed:
+        echo(f"run from {furl(source).remove(password=True)} failed", err=True)
+    if failed:
+        raise Exit(1)
+
+
 @cli.command()
 def doctor():
     shell("pg_dump --version")
     shell("pg_restore --version")
     shell("mongodump --version")
     shell("mongorestore --version")
-    shell("gsutil --version")
 
 
 @cli.callback()
@@ -0,0 +1,27 @@
+import json
+import os
+from pathlib import Path
+
+manifest_name = "manifest.json"
+
+
+def read_manifest(folder):
+    path = Path(folder) / manifest_name
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(folder, **updates):
+    manifest = read_manifest(folder)
+    manifest.update(updates)
+
+    path = Path(folder) / manifest_name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # replaced rather than rewritten, it may be hardlinked from a cache
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+    return manifest
@@ -1,71 +1,312 @@
 import base64
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+import io
+import json
+import logging
 import os
-import tempfile
+from pathlib import Path
+import shutil
+import threading
+from time import time
 
-from recycle.utils import shell
+from furl import furl
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+import google_crc32c
+from requests.adapters import HTTPAdapter
 
 CSEK_ENV = "GOOGLE_STORAGE_CSEK"
 SA_ENV = "GOOGLE_APPLICATION_CREDENTIALS"
+EMULATOR_ENV = "STORAGE_EMULATOR_HOST"
 
+n_threads = 16
+# size of the parts of composite uploads and of the ranges of downloads
+part_size = 64 << 20
+max_components = 32
 
-@contextmanager
-def service_account(bytes_content, decode64=True):
-    fd, tmp_fpath = tempfile.mkstemp()
-    os.close(fd)
 
-    try:
-        if SA_ENV in os.environ:
-            with open(tmp_fpath, "wb") as f:
-                if decode64:
-                    bytes_content = base64.b64decode(bytes_content)
+@lru_cache()
+def client():
+    # a single authenticated session, and its connection pool, for every transfer
+    if os.environ.get(EMULATOR_ENV):
+        gcs = storage.Client(project="test", credentials=AnonymousCredentials())
+    elif not os.environ.get(SA_ENV):
+        gcs = storage.Client()
+    elif Path(os.environ[SA_ENV]).is_file():
+        gcs = storage.Client.from_service_account_json(os.environ[SA_ENV])
+    else:
+        info = json.loads(base64.b64decode(os.environ[SA_ENV]))
+        gcs = storage.Client.from_service_account_info(info)
+
+    adapter = HTTPAdapter(pool_connections=n_threads, pool_maxsize=n_threads)
+    gcs._http.mount("https://", adapter)
+    gcs._http.mount("http://", adapter)
+    return gcs
+
+
+def parse(uri):
+    uri = furl(uri)
+    return uri.host, str(uri.path).strip("/")
+
+
+def blob(bucket, name):
+    key = os.environ.get(CSEK_ENV)
+    return (
+        client()
+        .bucket(bucket)
+        .blob(name, encryption_key=base64.b64decode(key) if key else None)
+    )
+
+
+def blobs(uri):
+    # the object named uri, or the objects under it
+    bucket, prefix = parse(uri)
+    return [
+        b
+        for b in client().list_blobs(bucket, prefix=prefix)
+        if not prefix or b.name == prefix or b.name.startswith(f"{prefix}/")
+    ]
+
+
+def crc32c(file):
+    checksum = google_crc32c.Checksum()
+    with open(file, "rb") as inp:
+        for chunk in iter(lambda: inp.read(1 << 20), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode()
+
 
-                f.write(bytes_content)
+def upload_part(file, bucket, name, start, size):
+    with open(file, "rb") as inp:
+        inp.seek(start)
+        blob(bucket, name).upload_from_file(inp, size=size, checksum="crc32c")
 
-            yield tmp_fpath
-        else:
-            yield None
-    finally:
-        os.remove(tmp_fpath)
+
+def compose(bucket, name, parts):
+    blob(bucket, name).compose([blob(bucket, part) for part in parts])
+    client().bucket(bucket).delete_blobs([blob(bucket, part) for part in parts])
 
 
 def push(uri, folder):
-    with service_account(os.environ.get(SA_ENV)) as sa:
+    """
+    Uploads the files of folder under uri, large files are uploaded in
+    parallel parts composed back into a single object.
+    """
+    start = time()
+    bucket, prefix = parse(uri)
+    files = [p for p in Path(folder).glob("**/*") if p.is_file()]
+    files.sort(key=lambda p: p.stat().st_size, reverse=True)
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        uploads = []
+        composites = []
+        for file in files:
+            name = "/".join(filter(None, [prefix, file.relative_to(folder).as_posix()]))
+            size = file.stat().st_size
+            logging.info(f"uploading {file} to gs://{bucket}/{name}")
+
+            if size <= part_size:
+                uploads.append(pool.submit(upload_part, file, bucket, name, 0, size))
+                continue
+
+            step = max(part_size, -(-size // max_components))
+            parts = []
+            for i, offset in enumerate(range(0, size, step)):
+                parts.append(f"{name}.part-{i}")
+                uploads.append(
+                    pool.submit(
+                        upload_part,
+                        file,
+                        bucket,
+                        parts[-1],
+                        offset,
+                        min(step, size - offset),
+                    )
+                )
+            composites.append((name, parts))
+
+        for future in uploads:
+            future.result()
+
+        for future in [pool.submit(compose, bucket, *c) for c in composites]:
+            future.result()
+
+    logging.info(f"pushed {len(files)} files in {round((time() - start) * 1000)}ms")
+
+
+def download_range(source, file, start, end):
+    with open(file, "r+b") as out:
+        out.seek(start)
+        client().download_blob_to_file(source, out, start=start, end=end, checksum=None)
+
 
-        cmd = "gsutil -m"
+def download(source, file):
+    with open(file, "wb") as out:
+        client().download_blob_to_file(source, out, checksum="crc32c")
 
-        if CSEK_ENV in os.environ:
-            cmd += f" -o GSUtil:encryption_key={os.environ[CSEK_ENV]}"
 
-        if sa is not None:
-            cmd += f" -o Credentials:gs_service_key_file={sa}"
+def fetch(uri, names, folder):
+    # downloads the objects named relatively to uri, small ones are expected
+    bucket, prefix = parse(uri)
 
-        cmd += f" cp -r {folder} {uri}"
-        shell(cmd)
+    def get(name):
+        file = Path(folder) / name
+        file.parent.mkdir(parents=True, exist_ok=True)
+        download(blob(bucket, "/".join(filter(None, [prefix, name]))), f"{file}.part")
+        os.replace(f"{file}.part", file)
 
+    with ThreadPoolExecutor(n_threads) as pool:
+        for _ in pool.map(get, names):
+            pass
 
-def pull(uri, folder):
-    with service_account(os.environ.get(SA_ENV)) as sa:
 
-        cmd = "gsutil -m"
+def cache_file(cache, bucket, b):
+    # generations are immutable, the crc32c guards against reused names
+    name = hashlib.sha256(f"{bucket}/{b.name}".encode()).hexdigest()[:32]
+    crc = base64.b64decode(b.crc32c).hex() if b.crc32c else "none"
+    return Path(cache) / f"{name}-{b.generation}-{crc}"
 
-        if CSEK_ENV in os.environ:
-            cmd += f" -o GSUtil:decryption_key1={os.environ[CSEK_ENV]}"
 
-        if sa is not None:
-            cmd += f" -o Credentials:gs_service_key_file={sa}"
+def link(source, file):
+    if file.exists():
+        os.remove(file)
+    try:
+        os.link(source, file)
+    except OSError:
+        # another filesystem
+        shutil.copyfile(source, file)
+
+
+def pull(uri, folder, cache=None):
+    """
+    Downloads the object named uri, or the objects under it, into folder.
+    Large objects are downloaded as concurrent ranges. With a cache folder,
+    objects already downloaded are hardlinked instead.
+    """
+    start = time()
+    bucket, prefix = parse(uri)
+    objects = blobs(uri)
+    if cache is not None:
+        Path(cache).mkdir(parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        downloads = []
+        fetched = []
+        for b in objects:
+            relative = Path(b.name).name if b.name == prefix else b.name[len(prefix) :]
+            file = Path(folder) / relative.lstrip("/")
+            file.parent.mkdir(parents=True, exist_ok=True)
+
+            cached = cache_file(cache, bucket, b) if cache is not None else None
+            if cached is not None and cached.exists():
+                logging.info(f"linking gs://{bucket}/{b.name} to {file} from cache")
+                link(cached, file)
+                continue
+
+            target = file
+            if cached is not None:
+                # pulls sharing the cache download to their own part files
+                part = f"{cached.name}.{os.getpid()}.{threading.get_ident()}.part"
+                target = cached.with_name(part)
+            source = blob(bucket, b.name)
+            logging.info(f"downloading gs://{bucket}/{b.name} to {file}")
+            fetched.append((b, file, target, cached))
+
+            if b.size <= part_size:
+                downloads.append(pool.submit(download, source, target))
+                continue
+
+            with open(target, "wb") as out:
+                out.truncate(b.size)
+            for offset in range(0, b.size, part_size):
+                end = min(offset + part_size, b.size) - 1
+                downloads.append(
+                    pool.submit(download_range, source, target, offset, end)
+                )
+
+        for future in downloads:
+            future.result()
+
+        for b, file, target, cached in fetched:
+            if b.size > part_size:
+                assert (
+                    b.crc32c is None or crc32c(target) == b.crc32c
+                ), f"{file} is corrupted"
+            if cached is not None:
+                # older generations of the object are not needed anymore
+                for previous in Path(cache).glob(f"{cached.name.split('-')[0]}-*"):
+                    if previous != cached and previous.suffix != ".part":
+                        previous.unlink(missing_ok=True)
+                # read only, files linked from the cache must be replaced, not rewritten
+                os.chmod(target, 0o444)
+                os.replace(target, cached)
+                link(cached, file)
+
+    logging.info(f"pulled {len(objects)} files in {round((time() - start) * 1000)}ms")
 
-        cmd += f" cp -r {uri} {folder}"
-        shell(cmd)
+
+class PipeReader(io.RawIOBase):
+    """
+    Reads a pipe as resumable uploads read files: reads are filled up to
+    their size and positions are counted.
+    """
+
+    def __init__(self, inp):
+        self.inp = inp
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size
+        while remaining != 0:
+            chunk = self.inp.read(remaining if remaining > 0 else 1 << 20)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk) if remaining > 0 else 0
+        data = b"".join(chunks)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+
+def upload_stream(uri, inp):
+    bucket, name = parse(uri)
+    target = blob(bucket, name)
+    target.chunk_size = part_size
+    target.upload_from_file(PipeReader(inp), checksum="crc32c")
+
+
+def download_stream(uri, out):
+    bucket, name = parse(uri)
+    client().download_blob_to_file(blob(bucket, name), out, checksum="crc32c")
 
 
 def list(uri):
-    with service_account(os.environ.get(SA_ENV)) as sa:
+    # same listing as gsutil ls -r, a header line per folder
+    bucket, prefix = parse(uri)
+    objects = blobs(uri)
+    if len(objects) == 1 and objects[0].name == prefix:
+        return [f"gs://{bucket}/{prefix}"]
+
+    folders = {}
+    for b in objects:
+        folder = os.path.dirname(b.name)
+        folders.setdefault(folder, []).append(b.name)
 
-        cmd = "gsutil"
+    listing = []
+    for folder, names in sorted(folders.items()):
+        listing.append(f"gs://{bucket}/{folder}/:" if folder else f"gs://{bucket}/:")
+        listing.extend(f"gs://{bucket}/{name}" for name in sorted(names))
+    return listing
 
-        if sa is not None:
-            cmd += f" -o Credentials:gs_service_key_file={sa}"
 
-        cmd += f" ls -r {uri}"
-        return [f for f in shell(cmd) if len(f) > 0]
+def exists(uri):
+    return len(blobs(uri)) > 0
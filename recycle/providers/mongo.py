@@ -1,57 +1,253 @@
+from collections import deque
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
 from datetime import timezone
-import gzip
+from functools import lru_cache
+import hashlib
 import itertools
 import json
 import logging
 import os
 from pathlib import Path
 import shutil
+import subprocess
 from time import sleep
+from typing import Callable
+from typing import Optional
 
 import bson
+from bson import json_util
+from bson.int64 import Int64
+from bson.raw_bson import RawBSONDocument
+import crcmod
 from furl import furl
 import pymongo
 from recycle import config
-from recycle.utils import fake_like_gen
+from recycle.compression import open_file
+from recycle.manifest import manifest_name
+from recycle.manifest import read_manifest
+from recycle.manifest import write_manifest
+from recycle.transforms import run_transforms
+from recycle.utils import anonymize_gen
+from recycle.utils import default_faker
+from recycle.utils import flush_mappings
+from recycle.utils import get_faker
+from recycle.utils import get_mapping
+from recycle.utils import is_preserved
+from recycle.utils import prefetch
+from recycle.utils import preserved_email_domains
+from recycle.utils import preserved_email_regex
 from recycle.utils import shell
+from recycle.utils import shell_all
+from recycle.utils import spawn
+from recycle.utils import wait
 from tqdm import tqdm
 
 
+@lru_cache()
+def client(uri):
+    # one connection pool per uri and process
+    return pymongo.MongoClient(uri)
+
+
 def get_database(uri):
-    return pymongo.MongoClient(uri).get_default_database()
+    return client(uri).get_default_database()
 
 
 def log_formatter(log):
     return " ".join(log.split()[1:])
 
 
-def dump_cli(uri, collection=None, folder="dump", n_parallel=10, jsonarray=False):
-    db_name = get_database(uri).name
+def keep_queries(ops: Optional[config.Ops], database, now=None, watermarks=None):
+    now = now or datetime.now(tz=timezone.utc)
+    keeps = {}
+    if ops is not None:
+        for collection, rules in ops.transforms.get(database, {}).items():
+            if rules.keep is not None and rules.drop is None:
+                lower = bson.ObjectId.from_datetime(now - rules.keep)
+                keeps[collection] = {"$gte": {"$oid": str(lower)}}
+
+    # incremental dumps take the documents inserted between two watermarks
+    bounds = {}
+    for collection, (since, until) in (watermarks or {}).items():
+        if since is not None:
+            bounds.setdefault(collection, {})["$gt"] = {"$oid": since}
+        if until is not None:
+            bounds.setdefault(collection, {})["$lte"] = {"$oid": until}
+
+    queries = {}
+    for collection in dict.fromkeys([*keeps, *bounds]):
+        query = {}
+        if collection in bounds:
+            query["_id"] = bounds[collection]
+        if collection in keeps:
+            # preserved documents are kept whatever their age, as in filtr
+            query["$or"] = [
+                {"_id": keeps[collection]},
+                {"email": {"$regex": preserved_email_regex}},
+            ]
+        queries[collection] = json.dumps(query, separators=(",", ":"))
+    return queries
+
+
+def dump_watermarks(uri, collection=None, previous=None):
+    """
+    (since, until) _id bounds of the next incremental dump of each collection,
+    collections without ObjectId _ids have no bounds and are dumped in full.
+    """
+    db = get_database(uri)
+    previous = previous or {}
+    collections = [collection] if collection is not None else db.list_collection_names()
+
+    watermarks = {}
+    for c in collections:
+        if c.startswith("system."):
+            continue
+        last = db[c].find_one(sort=[("_id", -1)], projection={"_id": True})
+        if last is not None and isinstance(last["_id"], bson.ObjectId):
+            watermarks[c] = (previous.get(c), str(last["_id"]))
+        else:
+            watermarks[c] = (None, None)
+    return watermarks
+
+
+def id_ranges(collection, n_ranges, sample_size=1000):
+    """
+    _id bounds splitting a collection into ranges of similar sizes, from a
+    sample of its _ids. Only collections of ObjectId _ids are split, range
+    queries would miss the _ids of other types.
+    """
+    if n_ranges < 2:
+        return [{}]
+    ends = [
+        collection.find_one(sort=[("_id", order)], projection={"_id": True})
+        for order in [1, -1]
+    ]
+    if any(end is None or not isinstance(end["_id"], bson.ObjectId) for end in ends):
+        return [{}]
+
+    sample = sorted(
+        doc["_id"]
+        for doc in collection.aggregate(
+            [{"$sample": {"size": sample_size}}, {"$project": {"_id": True}}]
+        )
+    )
+    edges = sorted({sample[len(sample) * i // n_ranges] for i in range(1, n_ranges)})
+
+    ranges = []
+    for lower, upper in zip([None] + edges, edges + [None]):
+        bound = {}
+        if lower is not None:
+            bound["$gte"] = {"$oid": str(lower)}
+        if upper is not None:
+            bound["$lt"] = {"$oid": str(upper)}
+        ranges.append(bound)
+    return ranges
+
+
+def join_exports(parts, file, jsonarray=False):
+    # mongoexport writes a document per line without --jsonArray
+    written = 0
+    with open(file, "w") as out:
+        if jsonarray:
+            out.write("[")
+        for part in parts:
+            with open(part) as inp:
+                for line in inp:
+                    if not line.strip():
+                        continue
+                    if jsonarray:
+                        line = ("," if written else "") + line.rstrip("\n")
+                    out.write(line)
+                    written += 1
+            os.remove(part)
+        if jsonarray:
+            out.write("]")
+
+
+def dump_cli(
+    uri,
+    collection=None,
+    folder="dump",
+    n_parallel=10,
+    jsonarray=False,
+    ndjson=False,
+    ops=None,
+    gzip=True,
+    watermarks=None,
+    split_size=1_000_000,
+):
+    db = get_database(uri)
+    db_name = db.name
     assert db_name is not None
 
+    queries = {}
+    if ops is not None or watermarks:
+        collections = db.list_collection_names()
+        queries = {
+            c: query
+            for c, query in keep_queries(ops, db_name, watermarks=watermarks).items()
+            if c in collections
+        }
+        for c, query in queries.items():
+            logging.info(f"Dumping {c} collection with query {query}")
+
     subfolder = str(furl(uri).path).split("/")[1].split("&")[0]
-    shell(f"mkdir -p {folder}/{subfolder}")
-    cmd = f"mongodump --uri={uri} --out={folder} --numParallelCollections={n_parallel} --gzip"
+    Path(folder, subfolder).mkdir(parents=True, exist_ok=True)
+    cmd = f"mongodump --uri={uri} --out={folder} --numParallelCollections={n_parallel}"
+    if gzip:
+        cmd += " --gzip"
     if jsonarray:
-        # collections = "db.getCollectionNames().forEach(element => print(element))"
-        collections = shell(
-            f"mongo --quiet {uri} --eval db.getCollectionNames()", json=True
-        )
+        names = [collection] if collection is not None else db.list_collection_names()
+        exports = []
+        parts = {}
+        for c in sorted(names):
+            if c.startswith("system."):
+                continue
+            file = f"{folder}/{subfolder}/{c}.json"
+            count = db[c].estimated_document_count()
+            ranges = id_ranges(db[c], min(n_parallel, -(-count // split_size)))
+            if len(ranges) > 1:
+                logging.info(f"Exporting {c} collection in {len(ranges)} ranges")
+                parts[file] = [f"{file}.part-{i}" for i in range(len(ranges))]
+            for i, bound in enumerate(ranges):
+                cmd = f"mongoexport --uri={uri} -c {c}"
+                cmd += f" --out {parts[file][i]}" if file in parts else f" --out {file}"
+                if not ndjson and file not in parts:
+                    cmd += " --jsonArray"
+                query = json.loads(queries[c]) if c in queries else None
+                if bound:
+                    query = (
+                        {"$and": [query, {"_id": bound}]} if query else {"_id": bound}
+                    )
+                if query:
+                    cmd += f" --query={json.dumps(query, separators=(',', ':'))}"
+                exports.append(cmd)
+        shell_all(exports, limit=n_parallel)
 
-        for collection in json.loads(collections):
-            shell(
-                f"mongoexport --uri={uri} -c {collection} --jsonArray --out {folder}/{subfolder}/{collection}.json"
-            )
-    else:
-        if collection is not None:
-            cmd += f" --collection={collection}"
+        for file, files in parts.items():
+            join_exports(files, file, jsonarray=not ndjson)
+    elif collection is not None:
+        cmd += f" --collection={collection}"
+        if collection in queries:
+            cmd += f" --query={queries[collection]}"
         shell(cmd, log_formatter=log_formatter)
+    else:
+        cmds = [cmd + "".join(f" --excludeCollection={c}" for c in queries)]
+        for c, query in queries.items():
+            cmd = (
+                f"mongodump --uri={uri} --out={folder} --collection={c} --query={query}"
+            )
+            if gzip:
+                cmd += " --gzip"
+            cmds.append(cmd)
+        # the filtered collections are dumped alongside the others
+        shell_all(cmds, log_formatter=log_formatter, limit=n_parallel)
 
 
-def restore_cli(
-    uri, collection=None, folder="dump", n_parallel=10, keep_previous=False
-):
+def restore_cmd(uri, collection=None, n_parallel=10, keep_previous=False):
     db_name = get_database(uri).name
     assert db_name is not None
 
@@ -61,17 +257,208 @@ def restore_cli(
         f"{db_name}.$collection$" if collection is None else f"{db_name}.{collection}"
     )
 
-    cmd = f"mongorestore --uri={uri} {folder} --nsFrom={ns_from} --nsTo={ns_to} --numParallelCollections={n_parallel} --gzip --convertLegacyIndexes"
+    cmd = f"mongorestore --uri={uri} --nsFrom={ns_from} --nsTo={ns_to} --numParallelCollections={n_parallel} --convertLegacyIndexes"
     if not keep_previous:
         cmd += " --drop"
 
-    shell(cmd, log_formatter=log_formatter)
+    return cmd
+
+
+def restore_cli(
+    uri, collection=None, folder="dump", n_parallel=10, keep_previous=False, gzip=True
+):
+    cmd = restore_cmd(uri, collection, n_parallel, keep_previous)
+    if gzip:
+        cmd += " --gzip"
+    shell(f"{cmd} {folder}", log_formatter=log_formatter)
+
+
+def stream_cli(
+    source_uri,
+    sink_uri,
+    collection=None,
+    n_parallel=10,
+    keep_previous=False,
+    ops=None,
+):
+    cmd = (
+        f"mongodump --uri={source_uri} --archive --numParallelCollections={n_parallel}"
+    )
+    if collection is not None:
+        cmd += f" --collection={collection}"
+    sink_cmd = restore_cmd(sink_uri, collection, n_parallel, keep_previous)
+    sink_cmd += " --archive"
+
+    dump = spawn(cmd, log_formatter=log_formatter, stdout=subprocess.PIPE)
+    restore = None
+    try:
+        if ops is None:
+            # nothing to transform, let the two tools share the pipe directly
+            restore = spawn(sink_cmd, log_formatter=log_formatter, stdin=dump.stdout)
+            dump.stdout.close()
+        else:
+            restore = spawn(
+                sink_cmd, log_formatter=log_formatter, stdin=subprocess.PIPE
+            )
+            transform_archive(dump.stdout, restore.stdin, ops)
+            restore.stdin.close()
+
+        wait(dump)
+        wait(restore)
+    except BaseException:
+        for process in [dump, restore]:
+            if process is not None and process.poll() is None:
+                process.kill()
+        raise
+
+
+def resume_token_path(source_uri, sink_uri, collection=None):
+    # runs are identified by a digest, their uris hold credentials
+    run = hashlib.sha256(
+        json.dumps(
+            dict(source=source_uri, sink=sink_uri, collection=collection),
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+    return f".recycle-resume-token-{run[:16]}.json"
+
+
+def read_resume_token(path):
+    if not Path(path).exists():
+        return None
+    with open(path) as f:
+        return json_util.loads(f.read())
+
+
+def write_resume_token(token, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json_util.dumps(token))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def cluster_time(uri):
+    # replica set members report the operation time with every reply
+    return get_database(uri).command("ping")["operationTime"]
+
+
+def change_op(event, plans):
+    """
+    Collection, document key and sink write replaying a change event, the
+    document is transformed by the plan of its collection.
+    """
+    kind = event["operationType"]
+    collection = event.get("ns", {}).get("coll")
+
+    if kind not in ["insert", "update", "replace", "delete"]:
+        logging.warning(f"Ignoring {kind} event on {collection} collection")
+        return None
+
+    if collection in plans and plans[collection] is None:
+        return None
+
+    _id = event["documentKey"]["_id"]
+    key = bson.encode({"_id": _id})
+
+    if kind == "delete":
+        return collection, key, pymongo.DeleteOne({"_id": _id})
+
+    doc = event.get("fullDocument")
+    if doc is None:
+        # deleted since, its delete event follows
+        return None
+
+    plan = plans.get(collection)
+    if plan is not None and not plan(doc):
+        return None
+
+    return collection, key, pymongo.ReplaceOne({"_id": _id}, doc, upsert=True)
+
+
+def follow(
+    source_uri,
+    sink_uri,
+    ops: Optional[config.Ops] = None,
+    collection=None,
+    start_at=None,
+    token_path=None,
+    batch_size=1000,
+    max_await_ms=1000,
+):
+    source = get_database(source_uri)
+    sink = get_database(sink_uri)
+    now = datetime.now(tz=timezone.utc)
+
+    plans = {}
+    if ops is not None:
+        for c, rules in ops.transforms.get(source.name, {}).items():
+            mapping = ops.mapping if rules.deterministic else None
+            plans[c] = compile_plan(
+                rules,
+                now,
+                faker=get_faker(ops.pool),
+                mapping=get_mapping(mapping, ops.pool) if mapping else None,
+            )
+
+    kwargs = dict(
+        full_document="updateLookup",
+        max_await_time_ms=max_await_ms,
+        batch_size=batch_size,
+    )
+    token_path = token_path or resume_token_path(source_uri, sink_uri, collection)
+    token = read_resume_token(token_path)
+    if token is not None:
+        logging.info(f"Resuming change stream from {token_path}")
+        kwargs["resume_after"] = token
+    elif start_at is not None:
+        logging.info(f"Following change stream from {start_at}")
+        kwargs["start_at_operation_time"] = start_at
+
+    # a batch keeps the last write of each document, the bulk writes can
+    # then be unordered without reordering the changes of a document
+    pending = {}
+    n_pending = 0
+
+    def flush(token):
+        for c, writes in pending.items():
+            res = backoff_reconnect(
+                sink[c].bulk_write, list(writes.values()), ordered=False
+            ).bulk_api_result
+            logging.info(
+                f'{c}: {res["nUpserted"]} upserts, {res["nModified"]} modified, {res["nRemoved"]} deletes'
+            )
+        pending.clear()
+        flush_mappings()
+        write_resume_token(token, token_path)
+
+    target = source if collection is None else source[collection]
+    with target.watch(**kwargs) as stream:
+        while stream.alive:
+            event = stream.try_next()
+            if event is not None:
+                op = change_op(event, plans)
+                if op is not None:
+                    c, key, write = op
+                    pending.setdefault(c, {})[key] = write
+                    n_pending += 1
+            if (event is None and stream.resume_token != token) or (
+                n_pending >= batch_size
+            ):
+                token = stream.resume_token
+                flush(token)
+                n_pending = 0
+
+        if n_pending:
+            flush(stream.resume_token)
 
 
 def bson_file_name(bson_file):
     return str(
         Path(bson_file)
         .name.replace(".gz", "")
+        .replace(".zst", "")
         .replace(".bson", "")
         .replace(".slim", "")
     )
@@ -81,78 +468,429 @@ def json_file_name(json_file):
     return str(Path(json_file).name.replace(".json", ""))
 
 
-def transform(ops: config.Ops, folder="dump", jsonarray=False, **kwargs):
+def write_layer(snapshot, layer, watermarks, compression):
+    manifest = read_manifest(snapshot)
+
+    collections = {}
+    for file in Path(snapshot, layer).glob("*.bson*"):
+        since, _ = watermarks.get(bson_file_name(file), (None, None))
+        collections[bson_file_name(file)] = "full" if since is None else "delta"
+
+    # collections dumped in full, or without ObjectId _ids, start over
+    updated = dict(manifest.get("watermarks", {}))
+    for collection, (since, until) in watermarks.items():
+        updated.pop(collection, None)
+        if until is not None:
+            updated[collection] = until
+
+    created = datetime.now(tz=timezone.utc).isoformat()
+    return write_manifest(
+        snapshot,
+        compression=compression,
+        layers=manifest.get("layers", [])
+        + [dict(name=layer, created=created, collections=collections)],
+        watermarks=updated,
+    )
+
+
+def merge_layers(folder):
+    """
+    Replays the layers of the incremental snapshots found under folder: each
+    collection is its last full dump followed by the deltas dumped after it,
+    compressed streams are concatenated as is.
+    """
+    snapshots = [
+        path.parent
+        for path in Path(folder).glob(f"**/{manifest_name}")
+        if "layers" in read_manifest(path.parent)
+    ]
 
+    for snapshot in snapshots:
+        manifest = read_manifest(snapshot)
+        parts = {}
+        for layer in manifest["layers"]:
+            logging.info(f"Replaying {layer['name']} layer of {snapshot}")
+            for file in sorted(Path(snapshot, layer["name"]).iterdir()):
+                if file.name == manifest_name:
+                    continue
+                mode = layer["collections"].get(bson_file_name(file))
+                if ".bson" in file.name and mode == "delta":
+                    parts.setdefault(file.name, []).append(file)
+                else:
+                    parts[file.name] = [file]
+
+        for name, files in parts.items():
+            with open(snapshot / name, "wb") as out:
+                for file in files:
+                    with open(file, "rb") as inp:
+                        shutil.copyfileobj(inp, out, 1 << 20)
+
+        for layer in manifest["layers"]:
+            shutil.rmtree(snapshot / layer["name"])
+
+        os.remove(snapshot / manifest_name)
+        write_manifest(snapshot, compression=manifest["compression"])
+
+
+def transform(
+    ops: config.Ops, folder="dump", jsonarray=False, n_jobs=1, journal=None, **kwargs
+):
+    pattern = "*.json" if jsonarray else "*.bson*"
+
+    tasks = []
     for database, transform in ops.transforms.items():
-        files = [str(p) for p in Path(folder).glob(f"{database}/*.bson.gz")]
-        if jsonarray:
-            files = [str(p) for p in Path(folder).glob(f"{database}/*.json")]
-        for file in files:
+        for file in [str(p) for p in Path(folder).glob(f"{database}/{pattern}")]:
             collection_name = (
                 json_file_name(file) if jsonarray else bson_file_name(file)
             )
             rules = transform.get(collection_name)
-            if rules is None:
-                logging.info(f"No rules for {collection_name} collection")
-            else:
-                if rules.drop is not None:
-                    logging.info(f"Dropping collection {collection_name} collection")
-                    os.remove(file)
-                if rules.keep is not None:
-                    limit = datetime.now(tz=timezone.utc) - rules.keep
-                    logging.info(
-                        f"Rules keep from {limit} for {collection_name} collection"
-                    )
-                    filtr(
-                        file,
-                        lambda doc: limit <= doc["_id"].generation_time,
-                        jsonarray=jsonarray,
-                        **kwargs,
-                    )
-                if rules.anonymize is not {}:
-                    logging.info(f"Rules anonymize for {collection_name} collection")
-                    if len(rules.anonymize) > 0:
-                        override_gen = fake_like_gen(rules.anonymize)
-                        filtr(
-                            file,
-                            lambda doc: doc.update(override_gen()) or True,
-                            jsonarray=jsonarray,
-                            **kwargs,
-                        )
-
-
-def filtr(file, inplace_transformer, verbose=False, jsonarray=False):
+            tasks.append(
+                (file, collection_name, f"{database}/{collection_name}", rules, {})
+            )
+
+    return run_transforms(
+        transform_collection,
+        tasks,
+        ops,
+        "collection",
+        n_jobs=n_jobs,
+        journal=journal,
+        jsonarray=jsonarray,
+        **kwargs,
+    )
+
+
+def transform_collection(
+    file,
+    collection_name,
+    rules,
+    now,
+    faker=default_faker,
+    mapping=None,
+    jsonarray=False,
+    **kwargs,
+):
+    logs = []
+    read = written = 0
+
+    plan = compile_plan(rules, now, faker=faker, mapping=mapping)
+    if plan is None:
+        logs.append(f"Dropping collection {collection_name} collection")
+        os.remove(file)
+    else:
+        if plan.keep is not None:
+            logs.append(f"Rules keep from {plan.keep} for {collection_name} collection")
+        if plan.anonymize is not None:
+            logs.append(f"Rules anonymize for {collection_name} collection")
+        if plan.keep is not None or plan.anonymize is not None:
+            read, written = filtr(file, plan, jsonarray=jsonarray, **kwargs)
+
+    return logs, read, written
+
+
+def is_preserved_raw(data):
+    if b"email\x00" not in data:
+        return False
+    kind, start = raw_bson_value(data, "email")
+    if kind != 0x02:
+        return False
+    size = int.from_bytes(data[start : start + 4], "little")
+    email = data[start + 4 : start + 3 + size].decode()
+    return any(d in email for d in preserved_email_domains)
+
+
+@dataclass
+class Plan:
+    """
+    Collection rules applied as a single inplace transformer.
+    """
+
+    keep: Optional[datetime] = None
+    anonymize: Optional[Callable[[dict], dict]] = None
+
+    def __post_init__(self):
+        self.keep_time = self.keep.timestamp() if self.keep is not None else None
+
+    def __call__(self, doc):
+        if is_preserved(doc):
+            return True
+        if self.keep is not None:
+            # as the pushed down $gte query, ids other than ObjectIds are dropped
+            _id = doc.get("_id")
+            if not isinstance(_id, bson.ObjectId) or _id.generation_time < self.keep:
+                return False
+        if self.anonymize is not None:
+            doc.update(self.anonymize(doc))
+        return True
+
+    def raw(self, data):
+        if is_preserved_raw(data):
+            return data
+
+        if self.keep is not None:
+            generation_time = raw_object_id_time(data)
+            if generation_time is None or generation_time < self.keep_time:
+                return None
+
+        if self.anonymize is None:
+            return data
+
+        doc = bson.decode(data)
+        doc.update(self.anonymize(doc))
+        return bson.encode(doc)
+
+
+def compile_plan(rules: config.Transform, now, faker=default_faker, mapping=None):
+    if rules.drop is not None:
+        return None
+
+    return Plan(
+        keep=now - rules.keep if rules.keep is not None else None,
+        anonymize=anonymize_gen(rules.anonymize, faker=faker, mapping=mapping),
+    )
+
+
+def raw_bson_iter(inp):
+    while True:
+        head = inp.read(4)
+        if not head:
+            return
+        size = int.from_bytes(head, "little")
+        data = head + inp.read(size - 4)
+        if len(data) != size:
+            raise bson.errors.InvalidBSON("truncated bson document")
+        yield data
+
+
+bson_fixed_sizes = {
+    0x01: 8,
+    0x06: 0,
+    0x07: 12,
+    0x08: 1,
+    0x09: 8,
+    0x0A: 0,
+    0x10: 4,
+    0x11: 8,
+    0x12: 8,
+    0x13: 16,
+    0x7F: 0,
+    0xFF: 0,
+}
+
+
+def raw_bson_value_size(data, kind, start):
+    if kind in bson_fixed_sizes:
+        return bson_fixed_sizes[kind]
+    size = int.from_bytes(data[start : start + 4], "little")
+    if kind in (0x02, 0x0D, 0x0E):
+        return 4 + size
+    if kind in (0x03, 0x04, 0x0F):
+        return size
+    if kind == 0x05:
+        return 5 + size
+    if kind == 0x0B:
+        return data.index(b"\x00", data.index(b"\x00", start) + 1) + 1 - start
+    if kind == 0x0C:
+        return 4 + size + 12
+    raise bson.errors.InvalidBSON(f"unknown element type {kind:#x}")
+
+
+def raw_bson_value(data, name):
+    """
+    Type and value offset of a top level field, read without decoding.
+    """
+    key = name.encode() + b"\x00"
+    pos = 4
+    while pos < len(data) - 1:
+        kind = data[pos]
+        start = data.index(b"\x00", pos + 1) + 1
+        if data[pos + 1 : start] == key:
+            return kind, start
+        pos = start + raw_bson_value_size(data, kind, start)
+    return None, None
+
+
+def raw_object_id_time(data):
+    # mongod always stores _id first, fall back to a scan otherwise
+    if data[4] == 0x07 and data[5:9] == b"_id\x00":
+        return int.from_bytes(data[9:13], "big")
+
+    kind, start = raw_bson_value(data, "_id")
+    if kind != 0x07:
+        return None
+    return int.from_bytes(data[start : start + 4], "big")
+
+
+archive_magic = (0x8199E26D).to_bytes(4, "little")
+archive_terminator = b"\xff\xff\xff\xff"
+
+
+def archive_blocks(inp):
+    while True:
+        head = inp.read(4)
+        if not head:
+            return
+        if head == archive_terminator:
+            yield head
+            continue
+        size = int.from_bytes(head, "little")
+        data = head + inp.read(size - 4)
+        if len(data) != size:
+            raise bson.errors.InvalidBSON("truncated archive block")
+        yield data
+
+
+# CRC-64/XZ, the reflected ECMA-182 checksum of mongodump archives
+crc64_ecma = crcmod.mkCrcFun(
+    0x142F0E1EBA9EA3693, initCrc=0, rev=True, xorOut=0xFFFFFFFFFFFFFFFF
+)
+
+
+def crc64(crc, data):
+    return crc64_ecma(data, crc)
+
+
+def signed_int64(value):
+    return Int64(value - (1 << 64) if value >= 1 << 63 else value)
+
+
+def transform_archive(inp, out, ops: config.Ops, now=None):
+    """
+    Applies the collection plans to a mongodump --archive stream, recomputing
+    the checksum of every transformed namespace for mongorestore.
+    """
+    now = now or datetime.now(tz=timezone.utc)
+    faker = get_faker(ops.pool)
+    plans = {}
+    crcs = {}
+
+    # False marks namespaces without rules, streamed through untouched
+    def plan_for(ns):
+        if ns not in plans:
+            rules = ops.transforms.get(ns[0], {}).get(ns[1])
+            mapping = None
+            if rules is not None and rules.deterministic:
+                mapping = get_mapping(ops.mapping, ops.pool)
+            plans[ns] = (
+                False if rules is None else compile_plan(rules, now, faker, mapping)
+            )
+        return plans[ns]
+
+    assert inp.read(4) == archive_magic, "not a mongodump archive"
+    out.write(archive_magic)
+
+    # prelude: archive header and collections metadata up to the terminator
+    for data in archive_blocks(inp):
+        out.write(data)
+        if data == archive_terminator:
+            break
+
+    ns = None
+    for data in archive_blocks(inp):
+        if data == archive_terminator:
+            out.write(data)
+            ns = None
+        elif ns is None:
+            header = bson.decode(data)
+            ns = (header["db"], header["collection"])
+            if header.get("EOF") and plan_for(ns) is not False:
+                header["CRC"] = signed_int64(crcs.pop(ns, 0))
+                data = bson.encode(header)
+            out.write(data)
+        else:
+            plan = plan_for(ns)
+            if plan is None:
+                continue
+            if plan is not False:
+                data = plan.raw(data)
+                if data is None:
+                    continue
+                crcs[ns] = crc64(crcs.get(ns, 0), data)
+            out.write(data)
+    flush_mappings()
+
+
+def json_array_iter(inp, chunk_size=1 << 16):
+    decoder = json.JSONDecoder(object_hook=json_util.object_hook)
+    buffer = inp.read(chunk_size).lstrip()
+    assert buffer.startswith("["), "expected a json array"
+    pos = 1
+    eof = False
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+
+        try:
+            doc, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = inp.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+
+        yield doc
+        pos = end
+
+
+def json_lines_iter(inp):
+    for line in inp:
+        if line.strip():
+            yield json_util.loads(line)
+
+
+def json_dumps(doc):
+    return json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS)
+
+
+def filtr(file, inplace_transformer, verbose=False, jsonarray=False, ndjson=False):
     file = str(file)
     output_file = (
         str(file).replace(".json", ".slim.json")
         if jsonarray
         else str(file).replace(".bson", ".slim.bson")
     )
-    reader = gzip.open if file.endswith(".gz") else open
     progress = tqdm if verbose else lambda x: x
-    binary = "b" if not jsonarray else ""
-    with reader(file, f"r{binary}") as inp:
-        with reader(output_file, f"w{binary}") as out:
-            if not jsonarray:
+    mode = "b" if not jsonarray else "t"
+    read = written = 0
+    with open_file(file, f"r{mode}") as inp:
+        with open_file(output_file, f"w{mode}") as out:
+            if not jsonarray and isinstance(inplace_transformer, Plan):
+                for data in progress(raw_bson_iter(inp)):
+                    read += 1
+                    data = inplace_transformer.raw(data)
+                    if data is not None:
+                        out.write(data)
+                        written += 1
+            elif not jsonarray:
                 for doc in progress(bson.decode_file_iter(inp)):
-                    if "email" in doc:
-                        if "smood." in doc["email"] or "jamtech." in doc["email"]:
-                            out.write(bson.encode(doc))
-                            continue
+                    read += 1
                     if inplace_transformer(doc):
                         out.write(bson.encode(doc))
+                        written += 1
+            elif ndjson:
+                for doc in progress(json_lines_iter(inp)):
+                    read += 1
+                    if inplace_transformer(doc):
+                        out.write(json_dumps(doc) + "\n")
+                        written += 1
             else:
-                json_output = []
-                for doc in progress(json.load(inp)):
-                    if "email" in doc:
-                        if "smood." in doc["email"] or "jamtech." in doc["email"]:
-                            out.write(bson.encode(doc))
-                            continue
+                out.write("[")
+                for doc in progress(json_array_iter(inp)):
+                    read += 1
                     if inplace_transformer(doc):
-                        json_output.append(doc)
-                out.write(json.dumps(json_output))
+                        out.write(("," if written else "") + json_dumps(doc))
+                        written += 1
+                out.write("]")
 
     os.replace(output_file, file)
+    return read, written
 
 
 def pretty_log_write_error(e):
@@ -171,6 +909,8 @@ def backoff_reconnect(fun_ops, *args, max_attempts=5, **kwargs):
         try:
             return fun_ops(*args, **kwargs)
         except pymongo.errors.AutoReconnect as e:
+            if attempt == max_attempts - 1:
+                raise e
             wait = 0.5 * pow(2, attempt)
             logging.warning(f"Reconnecting... {e}. Waiting {wait} seconds.")
             sleep(wait)
@@ -188,18 +928,42 @@ def batch_itr(itr, batch_size):
             break
 
 
+def batch_bytes_itr(itr, batch_bytes, max_batch_size=100_000):
+    batch = []
+    size = 0
+    for data in itr:
+        batch.append(data)
+        size += len(data)
+        if size >= batch_bytes or len(batch) >= max_batch_size:
+            yield batch
+            batch = []
+            size = 0
+    if len(batch):
+        yield batch
+
+
 def restore_py(
-    uri, collection=None, folder="dump", n_parallel=10, keep_previous=False, **kwargs
+    uri,
+    collection=None,
+    folder="dump",
+    n_parallel=10,
+    keep_previous=False,
+    journal=None,
+    gzip=True,
+    **kwargs,
 ):
-    db_name = get_database(uri).name
+    # a single client, and its connection pool, is shared by all collections
+    db = get_database(uri)
+    db_name = db.name
 
-    if not keep_previous:
+    if not keep_previous and not (journal and journal.done("backbone", db_name)):
+        extension = ".metadata.json.gz" if gzip else ".metadata.json"
         if collection is None:
             metadata_files = [
-                str(p) for p in Path(folder).glob(f"{db_name}/*.metadata.json.gz")
+                str(p) for p in Path(folder).glob(f"{db_name}/*{extension}")
             ]
         else:
-            metadata_files = [f"{db_name}/{collection}.metadata.json.gz"]
+            metadata_files = [str(Path(folder) / db_name / f"{collection}{extension}")]
 
         backbone_folder = Path(folder) / "backbone"
 
@@ -214,39 +978,124 @@ def restore_py(
             folder=backbone_folder,
             n_parallel=n_parallel,
             keep_previous=False,
+            gzip=gzip,
         )
 
         shutil.rmtree(backbone_folder)
+        if journal is not None:
+            journal.mark("backbone", db_name)
 
     if collection is None:
-        bson_files = [str(p) for p in Path(folder).glob(f"{db_name}/*.bson.gz")]
+        bson_files = [str(p) for p in Path(folder).glob(f"{db_name}/*.bson*")]
     else:
-        bson_files = [f"{db_name}/{collection}.bson.gz"]
+        bson_files = [
+            str(p) for p in Path(folder).glob(f"{db_name}/{collection}.bson*")
+        ]
 
-    for bson_file in bson_files:
-        collection_name = bson_file_name(bson_file)
-        restore_py_collection(uri, collection_name, bson_file, **kwargs)
+    if journal is not None:
+        bson_files = [
+            f
+            for f in bson_files
+            if not journal.done("restored", f"{db_name}/{bson_file_name(f)}")
+        ]
 
+    # largest collections first so they do not end up restoring alone
+    bson_files.sort(key=os.path.getsize, reverse=True)
 
-def restore_py_collection(uri, collection, bson_file, upsert=False, verbose=False):
-    db = get_database(uri)
+    with ThreadPoolExecutor(n_parallel) as pool:
+        futures = [
+            pool.submit(
+                restore_py_collection,
+                db,
+                bson_file_name(bson_file),
+                bson_file,
+                journal=journal,
+                **kwargs,
+            )
+            for bson_file in bson_files
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+
+def restore_py_collection(
+    uri,
+    collection,
+    bson_file,
+    upsert=False,
+    verbose=False,
+    batch_bytes=16 << 20,
+    n_in_flight=4,
+    journal=None,
+):
+    db = get_database(uri) if isinstance(uri, str) else uri
+    key = f"{db.name}/{collection}"
 
-    reader = gzip.open if bson_file.endswith(".gz") else open
     progress = tqdm if verbose else lambda x: x
+    codec_options = bson.CodecOptions(document_class=RawBSONDocument)
 
-    with reader(bson_file, "rb") as inp:
-        for docs in progress(batch_itr(bson.decode_file_iter(inp), 100)):
-            if upsert:
-                ops = [
-                    pymongo.ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
-                    for doc in docs
-                ]
-            else:
-                ops = [pymongo.InsertOne(doc) for doc in docs]
+    # byte offset, in the uncompressed file, up to which every batch was acknowledged
+    restoring = journal.get("restoring", key) if journal is not None else None
+    offset = restoring["offset"] if restoring is not None else 0
+    if offset:
+        logging.info(f"{collection}: resuming restore from byte {offset}")
 
-            res = backoff_reconnect(
-                db[collection].bulk_write, ops, ordered=False
-            ).bulk_api_result
-            logging.info(
-                f'{res["nInserted"]} inserts, {res["nModified"]} modified, {res["nUpserted"]} upserts'
-            )
+    def batches():
+        with open_file(bson_file, "rb") as inp:
+            skipped = 0
+            while skipped < offset:
+                skipped += len(inp.read(min(1 << 20, offset - skipped)))
+
+            end = offset
+            for batch in batch_bytes_itr(raw_bson_iter(inp), batch_bytes):
+                end += sum(len(data) for data in batch)
+                docs = [RawBSONDocument(data, codec_options) for data in batch]
+                if upsert:
+                    yield end, [
+                        pymongo.ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+                        for doc in docs
+                    ]
+                else:
+                    yield end, [pymongo.InsertOne(doc) for doc in docs]
+
+    def bulk_write(ops):
+        try:
+            return db[collection].bulk_write(ops, ordered=False).bulk_api_result
+        except pymongo.errors.BulkWriteError as e:
+            # batches in flight when the previous run died may be partially
+            # restored already, their duplicates are expected
+            if (
+                offset
+                and not e.details["writeConcernErrors"]
+                and all(we["code"] == 11000 for we in e.details["writeErrors"])
+            ):
+                logging.info(
+                    f'{collection}: {len(e.details["writeErrors"])} documents already restored'
+                )
+                return e.details
+            raise e
+
+    def write(end, ops):
+        return end, backoff_reconnect(bulk_write, ops)
+
+    def ack(future):
+        end, res = future.result()
+        logging.info(
+            f'{collection}: {res["nInserted"]} inserts, {res["nModified"]} modified, {res["nUpserted"]} upserts'
+        )
+        if journal is not None:
+            journal.mark("restoring", key, offset=end)
+
+    # batches are decoded in a background thread while up to n_in_flight
+    # bulk writes are waiting on the server, they are acknowledged in order
+    with ThreadPoolExecutor(n_in_flight) as pool:
+        pending = deque()
+        for end, ops in progress(prefetch(batches(), n_in_flight)):
+            pending.append(pool.submit(write, end, ops))
+            while len(pending) >= n_in_flight:
+                ack(pending.popleft())
+        while pending:
+            ack(pending.popleft())
+
+    if journal is not None:
+        journal.mark("restored", key)
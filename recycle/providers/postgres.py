@@ -1,10 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import datetime
+from datetime import timezone
+from fnmatch import fnmatchcase
+import io
 import logging
+import os
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import tempfile
+from time import time
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import quote
 
+from dateutil.parser import isoparse
+from furl import furl
 from recycle import config
+from recycle.compression import Compression
+from recycle.compression import detect
+from recycle.compression import open_file
+from recycle.transforms import run_transforms
+from recycle.utils import anonymize_gen
+from recycle.utils import default_faker
+from recycle.utils import flush_mappings
+from recycle.utils import get_faker
+from recycle.utils import get_mapping
+from recycle.utils import is_preserved
+from recycle.utils import preserved_email_domains
 from recycle.utils import shell
+from recycle.utils import spawn
+from recycle.utils import wait
 from sqlalchemy import create_engine
 from sqlalchemy.pool import NullPool
-import sqlparse
+from tqdm import tqdm
 
 
 def get_database(uri):
@@ -17,40 +51,966 @@ def log_formatter(log):
     return ":".join(log.split(":")[1:])
 
 
-def dump_cli(uri, table=None, folder="dump", n_parallel=10):
+# sections of toc entries
+section_data = 3
+section_post_data = 4
+
+
+@dataclass
+class TocEntry:
+    dump_id: int
+    tag: Optional[str] = None
+    desc: Optional[str] = None
+    namespace: Optional[str] = None
+    defn: Optional[str] = None
+    drop_stmt: Optional[str] = None
+    copy_stmt: Optional[str] = None
+    owner: Optional[str] = None
+    had_dumper: int = 0
+    table_oid: Optional[str] = "0"
+    oid: Optional[str] = "0"
+    section: int = 0
+    tablespace: Optional[str] = None
+    tableam: Optional[str] = None
+    relkind: int = 0
+    with_oids: Optional[str] = "false"
+    dependencies: List[int] = field(default_factory=list)
+    filename: Optional[str] = ""
+
+
+@dataclass
+class Toc:
+    """
+    Table of contents of a directory format dump, the toc.dat file.
+    """
+
+    version: Tuple[int, int, int] = (1, 14, 0)
+    int_size: int = 4
+    off_size: int = 8
+    format: int = 5
+    compression: int = 0
+    created: List[int] = field(default_factory=lambda: [0] * 7)
+    dbname: Optional[str] = None
+    remote_version: Optional[str] = None
+    dump_version: Optional[str] = None
+    entries: List[TocEntry] = field(default_factory=list)
+
+
+class TocReader:
+    def __init__(self, inp):
+        self.inp = inp
+        self.int_size = 4
+
+    def byte(self):
+        return self.inp.read(1)[0]
+
+    def int(self):
+        sign = self.byte()
+        value = int.from_bytes(self.inp.read(self.int_size), "little")
+        return -value if sign else value
+
+    def str(self):
+        size = self.int()
+        return self.inp.read(size).decode() if size >= 0 else None
+
+
+class TocWriter:
+    def __init__(self, out, int_size=4):
+        self.out = out
+        self.int_size = int_size
+
+    def byte(self, value):
+        self.out.write(bytes([value]))
+
+    def int(self, value):
+        self.byte(1 if value < 0 else 0)
+        self.out.write(abs(value).to_bytes(self.int_size, "little"))
+
+    def str(self, value):
+        if value is None:
+            self.int(-1)
+        else:
+            data = value.encode()
+            self.int(len(data))
+            self.out.write(data)
+
+
+def read_toc(folder="dump"):
+    # fields as read by pg_restore ReadHead and ReadToc, since archive 1.12
+    with open(Path(folder, "toc.dat"), "rb") as inp:
+        assert inp.read(5) == b"PGDMP", f"{folder} is not a directory format dump"
+        r = TocReader(inp)
+        toc = Toc(version=(r.byte(), r.byte(), r.byte()))
+        version = toc.version[:2]
+        assert (1, 12) <= version <= (1, 16), f"unsupported archive version {version}"
+
+        toc.int_size = r.int_size = r.byte()
+        toc.off_size = r.byte()
+        toc.format = r.byte()
+        toc.compression = r.byte() if version >= (1, 15) else r.int()
+        toc.created = [r.int() for _ in range(7)]
+        toc.dbname = r.str()
+        toc.remote_version = r.str()
+        toc.dump_version = r.str()
+
+        for _ in range(r.int()):
+            entry = TocEntry(dump_id=r.int())
+            entry.had_dumper = r.int()
+            entry.table_oid = r.str()
+            entry.oid = r.str()
+            entry.tag = r.str()
+            entry.desc = r.str()
+            entry.section = r.int()
+            entry.defn = r.str()
+            entry.drop_stmt = r.str()
+            entry.copy_stmt = r.str()
+            entry.namespace = r.str()
+            entry.tablespace = r.str()
+            if version >= (1, 14):
+                entry.tableam = r.str()
+            if version >= (1, 16):
+                entry.relkind = r.int()
+            entry.owner = r.str()
+            entry.with_oids = r.str()
+            dependency = r.str()
+            while dependency is not None:
+                entry.dependencies.append(int(dependency))
+                dependency = r.str()
+            entry.filename = r.str()
+            toc.entries.append(entry)
+
+    return toc
+
+
+def write_toc(toc: Toc, folder="dump"):
+    version = toc.version[:2]
+    buffer = io.BytesIO()
+    w = TocWriter(buffer, toc.int_size)
+
+    buffer.write(b"PGDMP")
+    for value in [*toc.version, toc.int_size, toc.off_size, toc.format]:
+        w.byte(value)
+    if version >= (1, 15):
+        w.byte(toc.compression)
+    else:
+        w.int(toc.compression)
+    for value in toc.created:
+        w.int(value)
+    w.str(toc.dbname)
+    w.str(toc.remote_version)
+    w.str(toc.dump_version)
+
+    w.int(len(toc.entries))
+    for entry in toc.entries:
+        w.int(entry.dump_id)
+        w.int(entry.had_dumper)
+        w.str(entry.table_oid)
+        w.str(entry.oid)
+        w.str(entry.tag)
+        w.str(entry.desc)
+        w.int(entry.section)
+        w.str(entry.defn)
+        w.str(entry.drop_stmt)
+        w.str(entry.copy_stmt)
+        w.str(entry.namespace)
+        w.str(entry.tablespace)
+        if version >= (1, 14):
+            w.str(entry.tableam)
+        if version >= (1, 16):
+            w.int(entry.relkind)
+        w.str(entry.owner)
+        w.str(entry.with_oids)
+        for dependency in entry.dependencies:
+            w.str(str(dependency))
+        w.str(None)
+        w.str(entry.filename)
+
+    file = Path(folder, "toc.dat")
+    with open(f"{file}.tmp", "wb") as out:
+        out.write(buffer.getvalue())
+    os.replace(f"{file}.tmp", file)
+
+
+def keep_predicates(ops: Optional[config.Ops], database, now=None, email_tables=()):
+    """
+    Where clauses of the tables whose rows are filtered by the database
+    rather than dumped in full, from the keep, drop and where rules.
+    """
+    now = now or datetime.now(tz=timezone.utc)
+    predicates = {}
+    if ops is None:
+        return predicates
+
+    for table, rules in ops.transforms.get(database, {}).items():
+        table = table.strip('"')
+        conditions = []
+        if rules.drop is not None:
+            conditions.append("FALSE")
+        if rules.keep is not None:
+            assert rules.timestamp is not None, f"keep of {table} needs a timestamp"
+            column = quote_ident(rules.timestamp)
+            lower = (now - rules.keep).isoformat()
+            # as the transform, rows without a timestamp or preserved are kept
+            keep = [f"{column} >= '{lower}'", f"{column} IS NULL"]
+            if table in email_tables:
+                keep += [
+                    f"""strpos("email", '{d.replace("'", "''")}') > 0"""
+                    for d in preserved_email_domains
+                ]
+            conditions.append(f"({' OR '.join(keep)})")
+        if rules.where is not None:
+            conditions.append(f"({rules.where})")
+        if len(conditions):
+            predicates[table] = " AND ".join(conditions)
+    return predicates
+
+
+email_tables_query = """
+SELECT table_schema, table_name FROM information_schema.columns
+WHERE column_name = 'email'
+"""
+
+
+def email_tables(uri):
+    # tables as named by the rules, with or without their schema
+    tables = set()
+    for schema, table in get_database(uri).execute(email_tables_query):
+        tables |= {table, f"{schema}.{table}"}
+    return tables
+
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def table_pattern(table):
+    # exact pg_dump pattern of table or schema.table
+    return ".".join(quote_ident(name) for name in table.split("."))
+
+
+def table_patterns(table=None):
+    # tables are selected by comma separated names or globs, schema.* for schemas
+    return [t.strip() for t in (table or "").split(",") if t.strip()]
+
+
+def table_matches(patterns, schema, name):
+    return any(
+        fnmatchcase(f"{schema}.{name}", pattern) or fnmatchcase(name, pattern)
+        for pattern in patterns
+    )
+
+
+def export_snapshot(uri):
+    # held open so that the filtered copies see the data pg_dump sees
+    connection = get_database(uri).raw_connection()
+    connection.connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute("BEGIN ISOLATION LEVEL REPEATABLE READ")
+    cursor.execute("SELECT pg_export_snapshot()")
+    return connection, cursor.fetchone()[0]
+
+
+# columns copied by pg_dump, and whether their binary format can be copied
+table_columns_query = """
+SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname), c.relkind,
+    quote_ident(a.attname), a.attname,
+    t.typnamespace = 'pg_catalog'::regnamespace AND t.typsend <> 0
+FROM pg_attribute a
+JOIN pg_class c ON c.oid = a.attrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_type t ON t.oid = a.atttypid
+WHERE n.nspname = %s AND c.relname = %s AND a.attnum > 0 AND NOT a.attisdropped
+    AND COALESCE(to_jsonb(a) ->> 'attgenerated', '') = ''
+ORDER BY a.attnum
+"""
+
+
+def copy_table(uri, entry: TocEntry, where, file, compression, snapshot=None):
+    """
+    Streams the rows of a table matching where into a data file, returns the
+    COPY statement restoring them, or None for tables holding no rows.
+    """
+    connection = get_database(uri).raw_connection()
+    try:
+        connection.connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute("BEGIN ISOLATION LEVEL REPEATABLE READ")
+        if snapshot is not None:
+            cursor.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+
+        cursor.execute(table_columns_query, (entry.namespace, entry.tag))
+        rows = cursor.fetchall()
+        if not len(rows) or rows[0][1] != "r":
+            # partitioned tables, their partitions hold the rows
+            cursor.execute("ROLLBACK")
+            return None
+        name = rows[0][0]
+        columns = ", ".join(row[2] for row in rows)
+
+        start = time()
+        with open_file(file, "wb", compression=compression) as out:
+            cursor.execute(
+                f"COPY (SELECT {columns} FROM {name} WHERE {where}) TO STDOUT",
+                stream=out,
+            )
+        cursor.execute("COMMIT")
+        logging.info(f"{name} dumped in {round((time() - start) * 1000)}ms")
+    finally:
+        connection.close()
+
+    return f"COPY {name} ({columns}) FROM stdin;\n"
+
+
+def dump_filtered(uri, folder, predicates, snapshot=None, n_parallel=10):
+    """
+    Dumps the rows of the tables pg_dump left without data and adds their
+    TABLE DATA entries to the table of contents, before the post-data ones.
+    """
+    toc = read_toc(folder)
+    dumped = {(e.namespace, e.tag) for e in toc.entries if e.desc == "TABLE DATA"}
+    # the data files are compressed as the ones of pg_dump, gzip only here
+    compression = Compression("gzip" if toc.compression != 0 else "none")
+
+    next_id = max(e.dump_id for e in toc.entries) + 1
+    filtered = []
+    for table in toc.entries:
+        if table.desc != "TABLE" or (table.namespace, table.tag) in dumped:
+            continue
+        name = f"{table.namespace}.{table.tag}"
+        where = predicates.get(name, predicates.get(table.tag))
+        if where is None:
+            continue
+        logging.info(f"Dumping {name} table where {where}")
+        dump_id = next_id + len(filtered)
+        entry = TocEntry(
+            dump_id=dump_id,
+            tag=table.tag,
+            desc="TABLE DATA",
+            namespace=table.namespace,
+            defn="",
+            drop_stmt="",
+            owner=table.owner,
+            had_dumper=1,
+            table_oid=table.table_oid,
+            oid=table.oid,
+            section=section_data,
+            dependencies=[table.dump_id],
+            filename=f"{dump_id}.dat",
+        )
+        file = Path(folder, f"{entry.filename}{compression.extension}")
+        filtered.append((entry, where, file))
+
+    with ThreadPoolExecutor(n_parallel) as pool:
+        futures = [
+            pool.submit(copy_table, uri, entry, where, file, compression, snapshot)
+            for entry, where, file in filtered
+        ]
+        for (entry, _, _), future in zip(filtered, futures):
+            entry.copy_stmt = future.result()
+
+    entries = [entry for entry, _, _ in filtered if entry.copy_stmt is not None]
+    position = next(
+        (i for i, e in enumerate(toc.entries) if e.section == section_post_data),
+        len(toc.entries),
+    )
+    toc.entries[position:position] = entries
+    write_toc(toc, folder)
+
+
+def dump_cli(uri, table=None, folder="dump", n_parallel=10, compression=None, ops=None):
     cmd = f"pg_dump --verbose --clean --file={folder} --format=d --jobs={n_parallel}"
 
-    if table is not None:
-        cmd += f" --table={table}"
+    if compression is not None:
+        level = (compression.level or 6) if compression.codec == "gzip" else 0
+        cmd += f" --compress={level}"
 
-    cmd += f" {uri}"
-    shell(cmd, log_formatter=log_formatter)
+    for pattern in table_patterns(table):
+        cmd += f" --table={pattern}"
+
+    predicates = {}
+    if ops is not None:
+        database = str(furl(uri).path).strip("/")
+        predicates = keep_predicates(ops, database, email_tables=email_tables(uri))
+    if not len(predicates):
+        shell(f"{cmd} {uri}", log_formatter=log_formatter)
+        return
+
+    cmd = cmd.split() + [f"--exclude-table-data={table_pattern(t)}" for t in predicates]
+    exporter, snapshot = export_snapshot(uri)
+    try:
+        shell(cmd + [f"--snapshot={snapshot}", uri], log_formatter=log_formatter)
+        dump_filtered(uri, folder, predicates, snapshot, n_parallel)
+    finally:
+        exporter.close()
+
+
+def pipe_sql(cmd, sink_uri, stop_on_error=True):
+    # pg_dump sql script played by psql as it is written
+    sink_cmd = f"psql --quiet --dbname={sink_uri}"
+    if stop_on_error:
+        sink_cmd += " --variable=ON_ERROR_STOP=1"
+
+    dump = spawn(cmd, log_formatter=log_formatter, stdout=subprocess.PIPE)
+    restore = None
+    try:
+        restore = spawn(
+            sink_cmd,
+            log_formatter=log_formatter,
+            stdin=dump.stdout,
+            stdout=subprocess.DEVNULL,
+        )
+        dump.stdout.close()
+        wait(dump)
+        wait(restore)
+    except BaseException:
+        for process in [dump, restore]:
+            if process is not None and process.poll() is None:
+                process.kill()
+        raise
+
+
+class RowWriter(io.RawIOBase):
+    """
+    Writes the COPY text rows written to it through a plan.
+    """
+
+    def __init__(self, out, plan):
+        self.out = out
+        self.plan = plan
+        self.rest = b""
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        rows = (self.rest + bytes(data)).split(b"\n")
+        self.rest = rows.pop()
+        for row in rows:
+            row = self.plan(row + b"\n")
+            if row is not None:
+                self.out.write(row)
+        return len(data)
+
+
+stream_tables_query = """
+SELECT n.nspname, c.relname
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'r'
+    AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND left(n.nspname, 3) <> 'pg_'
+    AND NOT EXISTS (
+        SELECT 1 FROM pg_depend d
+        WHERE d.classid = 'pg_class'::regclass AND d.objid = c.oid
+            AND d.deptype = 'e'
+    )
+ORDER BY pg_relation_size(c.oid) DESC
+"""
+
+
+def pipe_table(
+    source_uri,
+    sink_uri,
+    schema,
+    table,
+    where=None,
+    rules=None,
+    now=None,
+    pool=None,
+    mapping=None,
+    snapshot=None,
+):
+    """
+    Copies the rows of a table from source to sink through a pipe, never
+    holding more than its buffer. The binary format is used unless the
+    rows are transformed or a column type is not builtin.
+    """
+    start = time()
+    source = get_database(source_uri).raw_connection()
+    sink = get_database(sink_uri).raw_connection()
+    try:
+        source.connection.autocommit = True
+        sink.connection.autocommit = True
+        source_cursor = source.cursor()
+        sink_cursor = sink.cursor()
 
+        source_cursor.execute("BEGIN ISOLATION LEVEL REPEATABLE READ")
+        if snapshot is not None:
+            source_cursor.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+        source_cursor.execute(table_columns_query, (schema, table))
+        rows = source_cursor.fetchall()
+        name = rows[0][0]
+        columns = ", ".join(row[2] for row in rows)
 
-def restore_cli(uri, table=None, folder="dump", n_parallel=10, keep_previous=False):
+        plan = None
+        if rules is not None:
+            plan = compile_plan(
+                rules,
+                [row[3] for row in rows],
+                now,
+                faker=get_faker(pool),
+                mapping=get_mapping(mapping, pool) if mapping is not None else None,
+            )
+        binary = plan is None and all(row[4] for row in rows)
+        options = " (FORMAT binary)" if binary else ""
 
-    if table is None:
-        toc = shell(f"pg_restore --list --format=d --dbname={uri} {folder}")
+        copy_out = f"COPY {name} ({columns}) TO STDOUT{options}"
+        if where is not None:
+            copy_out = (
+                f"COPY (SELECT {columns} FROM {name} WHERE {where}) TO STDOUT{options}"
+            )
+        copy_in = f"COPY {name} ({columns}) FROM STDIN{options}"
+
+        inp, out = os.pipe()
+        reader = os.fdopen(inp, "rb", buffering=0)
+        writer = os.fdopen(out, "wb")
+
+        def load():
+            try:
+                sink_cursor.execute(copy_in, stream=reader)
+            finally:
+                reader.close()
+
+        sink_cursor.execute("BEGIN")
+        with ThreadPoolExecutor(1) as pool:
+            loading = pool.submit(load)
+            try:
+                try:
+                    stream = RowWriter(writer, plan) if plan is not None else writer
+                    source_cursor.execute(copy_out, stream=stream)
+                finally:
+                    # the sink reads until the end of the pipe
+                    try:
+                        writer.close()
+                    except BrokenPipeError:
+                        pass
+            except BaseException:
+                # a failed load breaks the pipe, its error is the one to report
+                if loading.done() and loading.exception() is not None:
+                    raise loading.exception()
+                raise
+            loading.result()
+        sink_cursor.execute("COMMIT")
+        source_cursor.execute("COMMIT")
+        flush_mappings()
+    finally:
+        source.close()
+        sink.close()
+
+    logging.info(
+        f"{name} copied in {round((time() - start) * 1000)}ms"
+        f"{' in binary' if binary else ''}"
+    )
+
+
+def stream_cli(
+    source_uri, sink_uri, table=None, n_parallel=10, keep_previous=False, ops=None
+):
+    """
+    Copies a database into another without intermediate files: the schema is
+    played by psql, the rows of n_parallel tables at a time are piped from
+    COPY TO to COPY FROM, then the sequences, indexes and constraints follow.
+    """
+    now = datetime.now(tz=timezone.utc)
+    database = str(furl(source_uri).path).strip("/")
+    predicates = {}
+    if ops is not None:
+        predicates = keep_predicates(
+            ops, database, now, email_tables=email_tables(source_uri)
+        )
+    transforms = {
+        t.strip('"'): rules
+        for t, rules in (ops.transforms.get(database, {}) if ops else {}).items()
+    }
+
+    exporter, snapshot = export_snapshot(source_uri)
+    try:
+        cmd = f"pg_dump --snapshot={snapshot}"
+        patterns = table_patterns(table)
+        for pattern in patterns:
+            cmd += f" --table={pattern}"
+
+        pre_data = f"{cmd} --section=pre-data"
+        if not keep_previous:
+            pre_data += " --clean --if-exists"
+        # without clean, objects already there fail and are skipped
+        pipe_sql(f"{pre_data} {source_uri}", sink_uri, stop_on_error=not keep_previous)
+
+        cursor = exporter.cursor()
+        cursor.execute(stream_tables_query)
         tables = [
-            entry.split()[5]
-            for entry in toc
-            if not entry.startswith(";")
-            and "TABLE" in entry
-            and "TABLE DATA" not in entry
+            (schema, name)
+            for schema, name in cursor.fetchall()
+            if not patterns or table_matches(patterns, schema, name)
         ]
-    else:
-        tables = [table]
 
-    if not keep_previous:
+        def copy(schema, name):
+            rules = transforms.get(f"{schema}.{name}", transforms.get(name))
+            where = predicates.get(f"{schema}.{name}", predicates.get(name))
+            if rules is not None and rules.drop is not None:
+                logging.info(f"Dropping {schema}.{name} table rows")
+                return
+            assert (
+                rules is None or not rules.deterministic or ops.mapping is not None
+            ), f"deterministic rules for {schema}.{name} need a mapping config"
+            if rules is not None and not len(rules.anonymize):
+                # keep is applied by the where clause already
+                rules = None
+            pipe_table(
+                source_uri,
+                sink_uri,
+                schema,
+                name,
+                where,
+                rules,
+                now,
+                pool=ops.pool if ops is not None else None,
+                mapping=ops.mapping if rules and rules.deterministic else None,
+                snapshot=snapshot,
+            )
+
+        with ThreadPoolExecutor(n_parallel) as pool:
+            for future in [pool.submit(copy, *t) for t in tables]:
+                future.result()
+
+        # sequence values, the only data left once table data is excluded
+        pipe_sql(f"{cmd} --data-only --exclude-table-data=*.* {source_uri}", sink_uri)
+        pipe_sql(
+            f"{cmd} --section=post-data {source_uri}",
+            sink_uri,
+            stop_on_error=not keep_previous,
+        )
+    finally:
+        exporter.close()
+
+
+# megabytes shared by the index builds of all pg_restore jobs of a fast load
+maintenance_work_mem = int(os.environ.get("RECYCLE_MAINTENANCE_WORK_MEM", 1024))
+
+
+def fast_load_settings(n_parallel, memory=None):
+    # every job may build an index at once, each gets its share of the memory
+    memory = memory or maintenance_work_mem
+    share = max(64, memory // max(n_parallel, 1))
+    return dict(synchronous_commit="off", maintenance_work_mem=f"{share}MB")
+
+
+def session_options(uri, settings):
+    # libpq reads server settings from the options parameter of the uri
+    options = quote(" ".join(f"-c {name}={value}" for name, value in settings.items()))
+    return f"{uri}{'&' if '?' in uri else '?'}options={options}"
+
+
+# dependencies of an entry which must be restored along for it to be
+blocking_descs = ["TABLE", "VIEW", "MATERIALIZED VIEW", "INDEX", "CONSTRAINT"]
+
+
+def select_entries(toc: Toc, patterns):
+    """
+    Entries of the tables matching patterns and of the objects depending on
+    them only: data, indexes, constraints, triggers, sequences and so on.
+    """
+    entries = {e.dump_id: e for e in toc.entries}
+    selected = {
+        e.dump_id
+        for e in toc.entries
+        if e.desc == "TABLE" and table_matches(patterns, e.namespace, e.tag)
+    }
+
+    size = None
+    while size != len(selected):
+        size = len(selected)
+        for entry in toc.entries:
+            dependencies = [entries[d] for d in entry.dependencies if d in entries]
+            if entry.dump_id in selected or not any(
+                d.dump_id in selected for d in dependencies
+            ):
+                continue
+            # foreign keys or views on tables left out
+            if any(
+                d.desc in blocking_descs and d.dump_id not in selected
+                for d in dependencies
+            ):
+                continue
+            selected.add(entry.dump_id)
+
+        # sequences of the defaults and identities selected
+        for dump_id in list(selected):
+            for d in entries[dump_id].dependencies:
+                if d in entries and entries[d].desc == "SEQUENCE":
+                    selected.add(d)
+
+    return [e for e in toc.entries if e.dump_id in selected]
+
+
+def write_list(entries, file):
+    # pg_restore --list format, only the leading dump ids are read back
+    with open(file, "w") as out:
+        for e in entries:
+            out.write(
+                f"{e.dump_id}; {e.table_oid} {e.oid} {e.desc} "
+                f"{e.namespace or '-'} {e.tag} {e.owner or '-'}\n"
+            )
+
+
+def restore_cli(
+    uri, table=None, folder="dump", n_parallel=10, keep_previous=False, fast=False
+):
+    toc = read_toc(folder)
+    patterns = table_patterns(table)
+    entries = select_entries(toc, patterns) if len(patterns) else toc.entries
+    assert len(entries), f"no table of {folder} matches {table}"
+
+    tables = [
+        f"{quote_ident(e.namespace)}.{quote_ident(e.tag)}"
+        for e in entries
+        if e.desc == "TABLE"
+    ]
+    if not keep_previous and len(tables):
         logging.info(f"dropping {', '.join(tables)}")
         cmd = f"psql {uri} -c ".split() + [
             "; ".join([f"DROP TABLE IF EXISTS {t}" for t in tables])
         ]
         shell(cmd, log_formatter=log_formatter)
 
-    cmd = f"pg_restore --verbose --format=d --jobs={n_parallel} --dbname={uri} {folder}"
+    cmd = f"pg_restore --verbose --format=d --jobs={n_parallel}"
+    with tempfile.TemporaryDirectory() as tmp:
+        if len(patterns):
+            # only the selected entries are read and restored
+            logging.info(f"restoring {len(entries)} of {len(toc.entries)} entries")
+            write_list(entries, Path(tmp, "restore.list"))
+            cmd += f" --use-list={Path(tmp, 'restore.list')}"
+
+        if not fast:
+            shell(f"{cmd} --dbname={uri} {folder}", log_formatter=log_formatter)
+            return
+
+        # rows first, then indexes and constraints built in parallel by
+        # pg_restore, largest tables first, with more memory and no commit waits
+        dbname = session_options(uri, fast_load_settings(n_parallel))
+        for section in ["pre-data", "data", "post-data"]:
+            start = time()
+            shell(
+                f"{cmd} --section={section} --dbname={dbname} {folder}",
+                log_formatter=log_formatter,
+            )
+            logging.info(f"{section} restored in {round((time() - start) * 1000)}ms")
+
+    cmd = f"vacuumdb --analyze-only --jobs={n_parallel} --dbname={uri}".split()
+    if len(patterns):
+        cmd += [f"--table={t}" for t in tables]
     shell(cmd, log_formatter=log_formatter)
 
 
-def transform(ops: config.Ops, folder="dump", **kwargs):
-    sqlparse.split("")
+copy_columns = re.compile(r'"((?:[^"]|"")*)"|([^\s,()]+)')
+
+
+def copy_stmt_columns(copy_stmt):
+    # COPY public.users (id, "Name", email) FROM stdin;
+    columns = copy_stmt[copy_stmt.index("(") + 1 : copy_stmt.rindex(")")]
+    return [
+        quoted.replace('""', '"') if quoted else plain
+        for quoted, plain in copy_columns.findall(columns)
+    ]
+
+
+def data_file(folder, entry: TocEntry):
+    # pg_dump appends the extension of its compression to the toc filename
+    for extension in ["", ".gz", ".zst"]:
+        file = Path(folder, f"{entry.filename}{extension}")
+        if file.exists():
+            return file
+    raise FileNotFoundError(f"no data file for {entry.namespace}.{entry.tag}")
+
+
+copy_escapes = re.compile(rb"\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)")
+copy_characters = {
+    b"b": b"\b",
+    b"f": b"\f",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"v": b"\v",
+}
+
+
+def copy_unescape(match):
+    value = match.group(1)
+    if value[:1] == b"x":
+        return bytes([int(value[1:], 16)])
+    if value[:1] in b"01234567":
+        return bytes([int(value, 8) & 0xFF])
+    return copy_characters.get(value, value)
+
+
+def copy_decode(value: bytes) -> Optional[str]:
+    if value == b"\\N":
+        return None
+    return copy_escapes.sub(copy_unescape, value).decode()
+
+
+def copy_encode(value) -> bytes:
+    if value is None:
+        return b"\\N"
+    value = str(value).replace("\\", "\\\\")
+    for escaped, character in [("\\n", "\n"), ("\\r", "\r"), ("\\t", "\t")]:
+        value = value.replace(character, escaped)
+    return value.encode()
+
+
+def parse_timestamp(value: str) -> Optional[datetime]:
+    try:
+        timestamp = isoparse(value)
+    except ValueError:
+        # infinity, BC dates
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+@dataclass
+class Plan:
+    """
+    Table rules applied to the rows of COPY text data.
+    """
+
+    columns: List[str]
+    keep: Optional[datetime] = None
+    timestamp: Optional[str] = None
+    anonymize: Optional[Callable[[dict], dict]] = None
+
+    def __post_init__(self):
+        self.positions = {column: i for i, column in enumerate(self.columns)}
+
+    def __call__(self, row: bytes) -> Optional[bytes]:
+        fields = row.rstrip(b"\n").split(b"\t")
+
+        email = self.positions.get("email")
+        if email is not None and is_preserved(dict(email=copy_decode(fields[email]))):
+            return row
+
+        if self.keep is not None:
+            value = copy_decode(fields[self.positions[self.timestamp]])
+            timestamp = parse_timestamp(value) if value is not None else None
+            if timestamp is not None and timestamp < self.keep:
+                return None
+
+        if self.anonymize is not None:
+            doc = {
+                column: copy_decode(field)
+                for column, field in zip(self.columns, fields)
+            }
+            for column, value in self.anonymize(doc).items():
+                # nulls stay null, constraints may rely on them
+                if fields[self.positions[column]] != b"\\N":
+                    fields[self.positions[column]] = copy_encode(value)
+
+        return b"\t".join(fields) + b"\n"
+
+
+def compile_plan(
+    rules: config.Transform, columns, now, faker=default_faker, mapping=None
+):
+    if rules.drop is not None:
+        return None
+
+    unknown = set(rules.anonymize) - set(columns)
+    assert not unknown, f"unknown columns {', '.join(sorted(unknown))}"
+    # text[] and json columns differ in their literals, columns take one value
+    nested = sorted(
+        c for c, kind in rules.anonymize.items() if isinstance(kind, (list, dict))
+    )
+    assert not nested, f"anonymize {', '.join(nested)} with a single fake type"
+    assert (
+        rules.keep is None or rules.timestamp in columns
+    ), "keep needs a timestamp column"
+
+    return Plan(
+        columns=columns,
+        keep=now - rules.keep if rules.keep is not None else None,
+        timestamp=rules.timestamp,
+        anonymize=anonymize_gen(rules.anonymize, faker=faker, mapping=mapping),
+    )
+
+
+def filtr(file, plan, verbose=False):
+    file = str(file)
+    output_file = file.replace(".dat", ".slim.dat")
+    progress = tqdm if verbose else lambda x: x
+    read = written = 0
+    with open_file(file, "rb") as inp:
+        with open_file(output_file, "wb", compression=detect(file)) as out:
+            for row in progress(inp):
+                if row == b"\\.\n":
+                    # end of data marker and the blank lines after it
+                    out.write(row)
+                    shutil.copyfileobj(inp, out)
+                    break
+                read += 1
+                if plan is not None:
+                    row = plan(row)
+                if row is not None:
+                    out.write(row)
+                    written += 1
+
+    os.replace(output_file, file)
+    return read, written
+
+
+def transform(ops: config.Ops, folder="dump", n_jobs=1, journal=None, **kwargs):
+    toc = read_toc(folder)
+    # hocon keeps the quotes of "schema.table" keys
+    transforms = {
+        table.strip('"'): rules
+        for table, rules in ops.transforms.get(toc.dbname, {}).items()
+    }
+
+    tasks = []
+    for entry in toc.entries:
+        if entry.desc != "TABLE DATA" or not entry.filename:
+            continue
+        table = f"{entry.namespace}.{entry.tag}"
+        rules = transforms.get(table, transforms.get(entry.tag))
+        columns = copy_stmt_columns(entry.copy_stmt)
+        tasks.append(
+            (
+                data_file(folder, entry),
+                table,
+                f"{toc.dbname}/{table}",
+                rules,
+                dict(columns=columns),
+            )
+        )
+
+    return run_transforms(
+        transform_table,
+        tasks,
+        ops,
+        "table",
+        n_jobs=n_jobs,
+        journal=journal,
+        **kwargs,
+    )
+
+
+def transform_table(
+    file, table, rules, now, faker=default_faker, mapping=None, columns=(), **kwargs
+):
+    logs = []
+    read = written = 0
+
+    plan = compile_plan(rules, columns, now, faker=faker, mapping=mapping)
+    if plan is None:
+        # pg_restore expects every data file, the table is restored empty
+        logs.append(f"Dropping {table} table rows")
+        read, written = filtr(file, lambda row: None)
+    else:
+        if plan.keep is not None:
+            logs.append(f"Rules keep from {plan.keep} for {table} table")
+        if plan.anonymize is not None:
+            logs.append(f"Rules anonymize for {table} table")
+        if plan.keep is not None or plan.anonymize is not None:
+            read, written = filtr(file, plan, **kwargs)
+
+    return logs, read, written
@@ -0,0 +1,53 @@
+import errno
+import logging
+import os
+from pathlib import Path
+import shutil
+
+
+def move_file(source, sink):
+    """
+    Renames source to sink, across filesystems it is copied next to sink and
+    renamed into place before the source is removed.
+    """
+    Path(sink).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(source, sink)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise e
+
+    tmp_path = f"{sink}.tmp"
+    shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, sink)
+    os.remove(source)
+
+
+def move_tree(source, sink):
+    """
+    Moves the files of source into sink, keeping their relative paths.
+    """
+    source = Path(source)
+    sink = Path(sink)
+    sink.mkdir(parents=True, exist_ok=True)
+    if source.resolve() == sink.resolve():
+        return
+
+    files = [
+        p
+        for p in source.glob("**/*")
+        if p.is_file() and sink.resolve() not in p.resolve().parents
+    ]
+    for file in files:
+        move_file(file, sink / file.relative_to(source))
+
+    for path in sorted(source.glob("**/*"), reverse=True):
+        if path.is_dir() and not any(path.iterdir()):
+            path.rmdir()
+
+    logging.info(f"moved {len(files)} files from {source} to {sink}")
+
+
+def remove_tree(folder):
+    shutil.rmtree(folder, ignore_errors=True)
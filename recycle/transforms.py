@@ -0,0 +1,106 @@
+from dataclasses import replace
+from datetime import datetime
+from datetime import timezone
+import logging
+import os
+from time import time
+
+from joblib import delayed
+from joblib import Parallel
+from recycle import config
+from recycle.utils import flush_mappings
+from recycle.utils import get_faker
+from recycle.utils import get_mapping
+
+
+def run_transforms(
+    transform_file, tasks, ops: config.Ops, kind, n_jobs=1, journal=None, **kwargs
+):
+    """
+    Transforms the files of (file, name, journal key, rules, params) tasks in a
+    pool of processes. transform_file(file, name, rules, now, faker, mapping,
+    **params, **kwargs) applies the rules to one file, it returns its logs and
+    the number of rows read and written.
+    """
+    # pooled workers keep the directory they started in, paths are absolute
+    mapping = ops.mapping
+    if mapping is not None and mapping.store is not None:
+        mapping = replace(mapping, store=os.path.abspath(mapping.store))
+    now = datetime.now(tz=timezone.utc)
+
+    scheduled = []
+    for file, name, key, rules, params in tasks:
+        if rules is None:
+            logging.info(f"No rules for {name} {kind}")
+        elif journal is not None and journal.done("transformed", key):
+            logging.info(f"{name} {kind} already transformed")
+        else:
+            assert (
+                not rules.deterministic or mapping is not None
+            ), f"deterministic rules for {name} need a mapping config"
+            scheduled.append((os.path.abspath(file), name, key, rules, params))
+
+    # largest files first so the pool is not left waiting on a big straggler
+    scheduled.sort(key=lambda task: os.path.getsize(task[0]), reverse=True)
+
+    # processes even within the workers of batch, which nest threads otherwise
+    results = Parallel(n_jobs=n_jobs, backend="loky")(
+        delayed(transform_task)(
+            transform_file,
+            file,
+            name,
+            rules,
+            now,
+            kind=kind,
+            pool=ops.pool,
+            mapping=mapping if rules.deterministic else None,
+            journal=journal,
+            journal_key=key,
+            **params,
+            **kwargs,
+        )
+        for file, name, key, rules, params in scheduled
+    )
+
+    for res in results:
+        for log in res["logs"]:
+            logging.info(log)
+        logging.info(
+            f'{res[kind]} {kind} transformed in {res["elapsed"]}ms: {res["read"]} read, {res["written"]} written'
+        )
+
+    return results
+
+
+def transform_task(
+    transform_file,
+    file,
+    name,
+    rules,
+    now,
+    kind,
+    pool=None,
+    mapping=None,
+    journal=None,
+    journal_key=None,
+    **kwargs,
+):
+    start = time()
+    res = {kind: name}
+
+    res["logs"], res["read"], res["written"] = transform_file(
+        file,
+        name,
+        rules,
+        now,
+        faker=get_faker(pool),
+        mapping=get_mapping(mapping, pool) if mapping is not None else None,
+        **kwargs,
+    )
+    flush_mappings()
+
+    if journal is not None:
+        journal.mark("transformed", journal_key)
+
+    res["elapsed"] = round((time() - start) * 1000)
+    return res
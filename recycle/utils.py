@@ -1,15 +1,241 @@
+import asyncio
+import atexit
+from functools import lru_cache
+import hashlib
+import hmac
+import itertools
 import logging
+import os
+import queue
+import random
 import re
+import sqlite3
 import subprocess
+import threading
 from time import time
+from typing import Optional
 import uuid
 
 from faker import Faker
+from recycle import config
 
 default_faker = Faker()
 hide_passwords = re.compile(r":([^:@]{2})[^:@]+([^:@]{2})@")
 
 
+class FakePool:
+    """
+    Faker lookalike drawing values from pools generated once per type.
+    """
+
+    def __init__(self, size=10_000, seed=None):
+        self.size = size
+        self.faker = Faker()
+        self.faker.seed_instance(seed)
+        self.random = random.Random(seed).random
+        self.pools = {}
+        # not seeded: emails must stay unique across worker processes
+        self.prefix = uuid.uuid4().hex[:12]
+        self.counter = itertools.count()
+
+    def values(self, kind):
+        values = self.pools.get(kind)
+        if values is None:
+            gen = getattr(self.faker, kind)
+            values = self.pools[kind] = [gen() for _ in range(self.size)]
+        return values
+
+    def draw(self, kind):
+        return self.values(kind)[int(self.random() * self.size)]
+
+    def pick(self, kind, n):
+        return self.values(kind)[n % self.size]
+
+    def phone_number(self):
+        return self.draw("phone_number")
+
+    def email(self):
+        return f"{self.prefix}{next(self.counter):x}-{self.draw('email')}"
+
+    def first_name(self):
+        return self.draw("first_name")
+
+    def last_name(self):
+        return self.draw("last_name")
+
+    def word(self):
+        return self.draw("word")
+
+
+@lru_cache()
+def fake_pool(size, seed):
+    return FakePool(size=size, seed=seed)
+
+
+def get_faker(pool: Optional[config.Pool] = None):
+    if pool is None:
+        return default_faker
+    return fake_pool(pool.size, pool.seed)
+
+
+fake_methods = dict(
+    phone="phone_number",
+    email="email",
+    firstname="first_name",
+    lastname="last_name",
+    str="word",
+)
+
+
+# mappings writing to a store, flushed by the tasks before they complete
+mapping_stores = []
+
+
+def flush_mappings():
+    for mapping in mapping_stores:
+        mapping.flush()
+
+
+atexit.register(flush_mappings)
+
+
+class FakeMapping:
+    """
+    Stable fake values keyed by a keyed hash of the original values, cached in
+    memory and optionally in a sqlite store shared between processes and runs.
+    """
+
+    def __init__(
+        self, key, faker=default_faker, store=None, cache_size=100_000, batch_size=1000
+    ):
+        self.key = key.encode()
+        self.faker = faker
+        self.seeded = Faker()
+        self.cache = lru_cache(maxsize=cache_size)(self.lookup)
+        self.batch_size = batch_size
+        self.pending = {}
+        # threads of a stream share the mapping, its connection and seeded faker
+        self.lock = threading.RLock()
+        self.db = None
+        if store is not None:
+            self.db = sqlite3.connect(
+                store, timeout=60, isolation_level=None, check_same_thread=False
+            )
+            self.db.execute("PRAGMA journal_mode=WAL")
+            # a crash loses the last commits only, they are generated again
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS mapping (digest TEXT PRIMARY KEY, value TEXT)"
+            )
+            mapping_stores.append(self)
+
+    def __call__(self, kind, value):
+        if value is None:
+            return None
+        return self.cache(kind, str(value))
+
+    def lookup(self, kind, value):
+        digest = hmac.new(self.key, f"{kind}:{value}".encode(), hashlib.sha256)
+        digest = digest.hexdigest()
+        with self.lock:
+            return self.lookup_digest(kind, digest)
+
+    def lookup_digest(self, kind, digest):
+        if self.db is not None:
+            if digest in self.pending:
+                return self.pending[digest]
+            row = self.db.execute(
+                "SELECT value FROM mapping WHERE digest = ?", (digest,)
+            ).fetchone()
+            if row is not None:
+                return row[0]
+
+        fake = self.generate(kind, digest)
+
+        if self.db is not None:
+            # processes sharing the key and pool generate the same values, new
+            # ones are written in batches and the first stored one is kept
+            self.pending[digest] = fake
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+        return fake
+
+    def flush(self):
+        with self.lock:
+            if self.db is None or not self.pending:
+                return
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO mapping VALUES (?, ?)", self.pending.items()
+            )
+            self.db.execute("COMMIT")
+            self.pending.clear()
+
+    def generate(self, kind, digest):
+        method = fake_methods[kind]
+        n = int(digest[:16], 16)
+
+        if isinstance(self.faker, FakePool):
+            fake = self.faker.pick(method, n)
+        else:
+            self.seeded.seed_instance(n)
+            fake = getattr(self.seeded, method)()
+
+        if kind == "email":
+            return f"{digest[:12]}-{fake}"
+        return fake
+
+
+@lru_cache()
+def fake_mapping(key, faker, store, cache_size):
+    return FakeMapping(key, faker=faker, store=store, cache_size=cache_size)
+
+
+def get_mapping(mapping: config.Mapping, pool: Optional[config.Pool] = None):
+    faker = default_faker
+    if pool is not None:
+        # unseeded pools would differ between processes, the key seeds them
+        seed = pool.seed
+        if seed is None:
+            digest = hmac.new(mapping.key.encode(), b"pool", hashlib.sha256)
+            seed = int(digest.hexdigest()[:16], 16)
+        faker = fake_pool(pool.size, seed)
+    return fake_mapping(mapping.key, faker, mapping.store, mapping.cache_size)
+
+
+def fake_map_gen(value, mapping):
+    if isinstance(value, dict):
+        ls = {k: fake_map_gen(v, mapping) for k, v in value.items()}
+        return lambda orig: {
+            k: v(orig.get(k) if isinstance(orig, dict) else None) for k, v in ls.items()
+        }
+
+    if isinstance(value, list):
+        ls = [fake_map_gen(v, mapping) for v in value]
+        return lambda orig: [
+            v(orig[i] if isinstance(orig, list) and i < len(orig) else None)
+            for i, v in enumerate(ls)
+        ]
+
+    if value in fake_methods:
+        return lambda orig: mapping(value, orig)
+
+    if value is None:
+        return lambda orig: None
+
+    raise NotImplementedError
+
+
+preserved_email_domains = ["smood.", "jamtech."]
+preserved_email_regex = "|".join(re.escape(d) for d in preserved_email_domains)
+
+
+def is_preserved(doc):
+    email = doc.get("email")
+    return isinstance(email, str) and any(d in email for d in preserved_email_domains)
+
+
 def fake_like_gen(value, faker=default_faker):
     if isinstance(value, dict):
         ls = {k: fake_like_gen(v, faker=faker) for k, v in value.items()}
@@ -23,6 +249,8 @@ def fake_like_gen(value, faker=default_faker):
         return faker.phone_number
 
     if value == "email":
+        if isinstance(faker, FakePool):
+            return faker.email
         return lambda: f"{uuid.uuid4().hex}-{faker.email()}"
 
     if value == "firstname":
@@ -40,34 +268,185 @@ def fake_like_gen(value, faker=default_faker):
     raise NotImplementedError
 
 
-def shell(cmd, log_formatter=None, json=False):
+def anonymize_gen(anonymize, faker=default_faker, mapping=None):
+    """
+    Values replacing the anonymized fields of a document, mapped from the
+    original ones if a mapping is given. None without anonymize rules.
+    """
+    if not len(anonymize):
+        return None
+
+    if mapping is not None:
+        return fake_map_gen(anonymize, mapping)
+
+    override_gen = fake_like_gen(anonymize, faker=faker)
+    return lambda doc: override_gen()
+
+
+def prefetch(itr, size=1):
+    """
+    Iterates over itr in a background thread, up to size items ahead. Stopping
+    early, e.g. on a failed write, stops the thread and closes itr.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in itr:
+                if not put((item, None)):
+                    break
+        except BaseException as e:
+            put((None, e))
+        else:
+            put((done, None))
+        finally:
+            if hasattr(itr, "close"):
+                itr.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+# processes running at once, across every event loop and thread
+max_processes = int(os.environ.get("RECYCLE_MAX_PROCESSES", 16))
+process_slots = threading.BoundedSemaphore(max_processes)
+
+
+async def run(cmd, log_formatter=None, json=False):
+    """
+    Runs a command once a process slot is free, its output is logged line by
+    line as it comes. Cancelling terminates the process.
+    """
     if not isinstance(cmd, list):
         cmd = cmd.split()
 
     command_name = str(cmd[0])
     logging.info(re.sub(hide_passwords, ":\\1****\\2@", " ".join(cmd)))
 
-    start = time()
-    logging.info(f"shell starting {command_name}")
+    while not process_slots.acquire(blocking=False):
+        await asyncio.sleep(0.05)
 
-    process = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=512
-    )
+    try:
+        start = time()
+        logging.info(f"shell starting {command_name}")
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=16 << 20,
+        )
 
-    ret = []
+        ret = []
+        logger = logging.getLogger(command_name)
+        try:
+            async for line in process.stdout:
+                out = line.decode().rstrip("\n")
+                ret.append(out)
+                if not json:
+                    logger.info(
+                        log_formatter(out) if log_formatter is not None else out
+                    )
+            returncode = await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), 5)
+                except asyncio.TimeoutError:
+                    process.kill()
+            raise
+    finally:
+        process_slots.release()
 
-    logger = logging.getLogger(command_name)
     if json:
-        output, error = process.communicate()
-        ret = output.decode("ascii").replace("\n", "").replace("\t", "")
+        ret = "".join(ret).replace("\t", "")
         logger.info(log_formatter(ret) if log_formatter is not None else ret)
-    else:
-        for line in process.stdout:
+
+    assert returncode == 0, f"shell {command_name} failed"
+    logging.info(f"shell terminated {command_name} {round((time() - start) * 1000)}ms")
+    return ret
+
+
+async def run_all(cmds, log_formatter=None, limit=None):
+    """
+    Runs commands concurrently, up to limit at once. The first failure
+    cancels the others.
+    """
+    limiter = asyncio.Semaphore(limit or len(cmds) or 1)
+
+    async def limited(cmd):
+        async with limiter:
+            return await run(cmd, log_formatter=log_formatter)
+
+    tasks = [asyncio.ensure_future(limited(cmd)) for cmd in cmds]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def shell(cmd, log_formatter=None, json=False):
+    return asyncio.run(run(cmd, log_formatter=log_formatter, json=json))
+
+
+def shell_all(cmds, log_formatter=None, limit=None):
+    return asyncio.run(run_all(cmds, log_formatter=log_formatter, limit=limit))
+
+
+def spawn(cmd, log_formatter=None, **kwargs):
+    if not isinstance(cmd, list):
+        cmd = cmd.split()
+
+    command_name = str(cmd[0])
+    logging.info(re.sub(hide_passwords, ":\\1****\\2@", " ".join(cmd)))
+    logging.info(f"spawn starting {command_name}")
+
+    process = subprocess.Popen(cmd, stderr=subprocess.PIPE, **kwargs)
+    process.start = time()
+    logger = logging.getLogger(command_name)
+
+    def log_stderr():
+        for line in process.stderr:
             out = line.decode().rstrip("\n")
-            ret.append(out)
             logger.info(log_formatter(out) if log_formatter is not None else out)
 
-    assert process.wait() == 0, f"shell {command_name} failed"
-    logging.info(f"shell terminated {command_name} {round((time() - start) * 1000)}ms")
+    process.stderr_logger = threading.Thread(target=log_stderr, daemon=True)
+    process.stderr_logger.start()
+    return process
 
-    return ret
+
+def wait(process):
+    command_name = str(process.args[0])
+    returncode = process.wait()
+    process.stderr_logger.join()
+
+    assert returncode == 0, f"spawn {command_name} failed"
+    logging.info(
+        f"spawn terminated {command_name} {round((time() - process.start) * 1000)}ms"
+    )
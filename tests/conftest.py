@@ -2,7 +2,9 @@ from os import environ
 from pathlib import Path
 import shutil
 
+from furl import furl
 import pytest
+from recycle.providers import gcs
 from recycle.providers import mongo
 from recycle.providers import postgres
 
@@ -25,6 +27,16 @@ postgres_test1 = f"{test_postgres_host}/test1"
 postgres_test2 = f"{test_postgres_host}/test2"
 
 
+@pytest.fixture(scope="session", autouse=True)
+def gcs_bucket():
+    # fake gcs servers start without buckets
+    if environ.get(gcs.EMULATOR_ENV):
+        bucket = furl(gcs_test1).host
+        if gcs.client().lookup_bucket(bucket) is None:
+            gcs.client().create_bucket(bucket)
+    yield
+
+
 @pytest.fixture()
 def clean_mongo():
     mongo.get_database(mongo_test1).command("dropDatabase")
@@ -0,0 +1,39 @@
+import bson
+from recycle import chunks
+from recycle.manifest import read_manifest
+
+
+class TestChunks:
+    def test_pack_unpack(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(chunks, "min_size", 1 << 10)
+        monkeypatch.setattr(chunks, "boundary_mask", 0xF)
+        store = str(tmp_path / "store")
+
+        docs = [bson.encode(dict(_id=i, name=f"name-{i}")) for i in range(5000)]
+        lines = [f"{i}\tname-{i}\n".encode() for i in range(5000)]
+
+        def write(folder, docs, lines):
+            (folder / "db").mkdir(parents=True)
+            (folder / "db" / "users.bson").write_bytes(b"".join(docs))
+            (folder / "1234.dat").write_bytes(b"".join(lines))
+
+        write(tmp_path / "day1", docs, lines)
+        chunks.pack(tmp_path / "day1", store)
+        assert sorted(p.name for p in (tmp_path / "day1").iterdir()) == [
+            "manifest.json"
+        ]
+        n_chunks = len(list((tmp_path / "store").glob("chunks/*/*")))
+
+        # a document inserted in the middle only changes the chunk around it
+        updated = docs[:2500] + [bson.encode(dict(_id=-1))] + docs[2500:]
+        write(tmp_path / "day2", updated, lines)
+        chunks.pack(tmp_path / "day2", store)
+        assert len(list((tmp_path / "store").glob("chunks/*/*"))) <= n_chunks + 2
+
+        chunks.unpack(tmp_path)
+        assert (tmp_path / "day1" / "db" / "users.bson").read_bytes() == b"".join(docs)
+        assert (tmp_path / "day2" / "db" / "users.bson").read_bytes() == b"".join(
+            updated
+        )
+        assert (tmp_path / "day2" / "1234.dat").read_bytes() == b"".join(lines)
+        assert read_manifest(tmp_path / "day2") == {}
@@ -1,5 +1,6 @@
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
 import logging
 from pathlib import Path
 import random
@@ -15,7 +16,10 @@ from tests.conftest import local_test1
 from tests.conftest import local_test2
 from tests.conftest import mongo_test1
 from tests.conftest import mongo_test2
+from tests.conftest import postgres_test1
+from tests.utils import read_bson
 from tests.utils import seed_mongo
+from tests.utils import write_bson
 from typer.testing import CliRunner
 
 
@@ -49,6 +53,17 @@ class TestCli:
         assert db1.count_documents({}) == 50
         assert db2.count_documents({}) == 50
 
+    def test_mongo_stream_mongo(self, caplog, clean_mongo, clean_fs):
+
+        seed_mongo(mongo_test1, "collection", 50)
+        db2 = mongo.get_database(mongo_test2)["collection"]
+
+        cmd = f"mongo {mongo_test1} {mongo_test2} --stream".split()
+        run(cmd)
+
+        assert db2.count_documents({}) == 50
+        assert not Path("dump").exists()
+
     def test_mongo_gcs(self, caplog, clean_mongo, clean_fs, snapshot):
 
         seed_mongo(mongo_test1, "collection", 50)
@@ -76,6 +91,54 @@ class TestCli:
             f"{local_test1.lstrip('./')}/{snapshot}/collection.metadata.json.gz",
         ]
 
+    def test_batch(self, caplog, clean_mongo, clean_fs, snapshot, tmp_path):
+
+        seed_mongo(mongo_test1, "collection", 50)
+        seed_mongo(mongo_test2, "collection", 50)
+
+        runs = tmp_path / "runs.hocon"
+        runs.write_text(
+            f"""
+            runs = [
+                {{ command = mongo, source = "{mongo_test1}", sink = "{local_test1}/{snapshot}" }}
+                {{ command = mongo, source = "{mongo_test2}", sink = "{local_test2}/{snapshot}" }}
+            ]
+            """
+        )
+        run(["batch", str(runs), "--jobs", "4", "--workdir", str(tmp_path / "runs")])
+
+        for local_test in [local_test1, local_test2]:
+            local_fs = [str(p) for p in Path(f"{local_test}/{snapshot}").glob("**/*")]
+            assert sorted(local_fs) == [
+                f"{local_test.lstrip('./')}/{snapshot}/collection.bson.gz",
+                f"{local_test.lstrip('./')}/{snapshot}/collection.metadata.json.gz",
+            ]
+
+    def test_batch_transform(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        now = datetime.now(tz=timezone.utc)
+        docs = [
+            dict(_id=bson.ObjectId.from_datetime(now - timedelta(days=i)), name=str(i))
+            for i in range(10)
+        ]
+        for i in range(3):
+            write_bson(tmp_path / f"source{i}" / "test1" / "users.bson.gz", docs)
+        (tmp_path / "ops.hocon").write_text(
+            "transforms { test1 { users { keep = 5d } } }"
+        )
+
+        # more runs than workers, the transform pools outlive the runs
+        runs = ", ".join(
+            f"{{ command = mongo, source = source{i}, sink = sink{i}, "
+            "transform = ops.hocon }"
+            for i in range(3)
+        )
+        run(["batch", f"runs = [{runs}]", "--jobs", "2", "--parallel", "1"])
+
+        for i in range(3):
+            users = read_bson(tmp_path / f"sink{i}" / "test1" / "users.bson.gz")
+            assert [u["name"] for u in users] == ["0", "1", "2", "3", "4"]
+
     def test_gcs_mongo(self, caplog, clean_mongo, clean_fs, snapshot):
 
         self.test_mongo_gcs(caplog, clean_mongo, clean_fs, snapshot)
@@ -193,3 +256,11 @@ class TestCli:
         processed = list(db2.find())
         for p in processed:
             assert p["to_anon"] != p["original"]
+
+    def test_chunk_store_compression(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+
+        for command, uri in [("mongo", mongo_test1), ("postgres", postgres_test1)]:
+            res = runner.invoke(cli, [command, uri, "snapshot", "--chunk-store", "s"])
+            assert res.exit_code != 0
+            assert "chunk store requires --compression none" in res.output
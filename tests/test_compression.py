@@ -0,0 +1,68 @@
+import gzip
+import os
+
+import pytest
+from recycle.compression import compress_tree
+from recycle.compression import decompress_tree
+from recycle.compression import open_file
+from recycle.compression import parse_compression
+
+
+class TestCompression:
+    def test_parse_compression(self):
+        assert parse_compression("none").extension == ""
+        assert parse_compression("gzip:1").level == 1
+        assert parse_compression("zstd").extension == ".zst"
+
+        with pytest.raises(AssertionError):
+            parse_compression("gzip:12")
+        with pytest.raises(AssertionError):
+            parse_compression("lz4")
+
+    def test_parallel_gzip(self, tmp_path):
+        data = os.urandom(1 << 16) * 64
+        file = tmp_path / "data.bson.gz"
+
+        with open_file(file, "wb", parse_compression("gzip:1"), threads=4) as out:
+            for i in range(0, len(data), 1000):
+                out.write(data[i : i + 1000])
+
+        with gzip.open(file, "rb") as inp:
+            assert inp.read() == data
+
+        with open_file(tmp_path / "empty.gz", "wb", threads=4):
+            pass
+        assert gzip.decompress((tmp_path / "empty.gz").read_bytes()) == b""
+
+    def test_zstd(self, tmp_path):
+        pytest.importorskip("zstandard")
+        data = os.urandom(1 << 10) * 1024
+        file = tmp_path / "data.json.zst"
+
+        with open_file(file, "wt", parse_compression("zstd"), threads=2) as out:
+            out.write(data.hex())
+
+        with open_file(file, "rt") as inp:
+            assert inp.read() == data.hex()
+
+        # layers of incremental snapshots are concatenated frames
+        with open(file, "ab") as out:
+            out.write(file.read_bytes())
+
+        with open_file(file, "rt") as inp:
+            assert inp.read() == data.hex() * 2
+
+    def test_compress_tree(self, tmp_path):
+        (tmp_path / "test1").mkdir()
+        (tmp_path / "test1" / "collection.bson").write_bytes(b"data" * 1000)
+        (tmp_path / "manifest.json").write_text("{}")
+
+        compress_tree(tmp_path, parse_compression("gzip:9"), threads=2)
+        assert sorted(p.name for p in tmp_path.glob("**/*.*")) == [
+            "collection.bson.gz",
+            "manifest.json",
+        ]
+
+        decompress_tree(tmp_path)
+        assert (tmp_path / "test1" / "collection.bson").read_bytes() == b"data" * 1000
+        assert not (tmp_path / "test1" / "collection.bson.gz").exists()
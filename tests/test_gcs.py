@@ -0,0 +1,83 @@
+import os
+from pathlib import Path
+import random
+
+import pytest
+from recycle.providers import gcs
+from tests.conftest import gcs_test1
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get(gcs.EMULATOR_ENV), reason="requires a fake gcs server"
+)
+
+
+@pytest.fixture()
+def prefix():
+    return f"{gcs_test1}/gcs-{random.randint(1, 100_000)}"
+
+
+class TestGcs:
+    def test_push_pull(self, tmp_path, prefix, monkeypatch):
+        monkeypatch.setattr(gcs, "part_size", 256 << 10)
+
+        files = {"small.bson": os.urandom(1000), "db/large.bson": os.urandom(1 << 20)}
+        for name, data in files.items():
+            (tmp_path / "push" / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / "push" / name).write_bytes(data)
+
+        gcs.push(prefix, tmp_path / "push")
+        assert gcs.list(prefix) == [
+            f"{prefix}/:",
+            f"{prefix}/small.bson",
+            f"{prefix}/db/:",
+            f"{prefix}/db/large.bson",
+        ]
+        assert gcs.exists(f"{prefix}/db/large.bson")
+        assert not gcs.exists(f"{prefix}/db/large")
+
+        gcs.pull(prefix, tmp_path / "pull")
+        for name, data in files.items():
+            assert (tmp_path / "pull" / name).read_bytes() == data
+
+        gcs.pull(f"{prefix}/small.bson", tmp_path / "single")
+        assert (tmp_path / "single" / "small.bson").read_bytes() == files["small.bson"]
+
+    def test_stream(self, tmp_path, prefix):
+        data = os.urandom(1 << 10)
+        read, write = os.pipe()
+        with open(write, "wb") as out:
+            out.write(data)
+        with open(read, "rb") as inp:
+            gcs.upload_stream(f"{prefix}/stream", inp)
+
+        with open(tmp_path / "stream", "wb") as out:
+            gcs.download_stream(f"{prefix}/stream", out)
+        assert Path(tmp_path / "stream").read_bytes() == data
+
+    def test_pull_cache(self, tmp_path, prefix):
+        (tmp_path / "push").mkdir()
+        (tmp_path / "push" / "a.bson").write_bytes(b"a")
+        (tmp_path / "push" / "b.bson").write_bytes(b"b")
+        gcs.push(prefix, tmp_path / "push")
+
+        cache = tmp_path / "cache"
+        gcs.pull(prefix, tmp_path / "pull1", cache=cache)
+        assert len(list(cache.iterdir())) == 2
+
+        # the download of another pull sharing the cache is left alone
+        entry = next(cache.iterdir())
+        part = entry.with_name(f"{entry.name}.1.1.part")
+        part.write_bytes(b"")
+
+        (tmp_path / "update").mkdir()
+        (tmp_path / "update" / "b.bson").write_bytes(b"bb")
+        gcs.push(prefix, tmp_path / "update")
+        gcs.pull(prefix, tmp_path / "pull2", cache=cache)
+        assert part.exists()
+        part.unlink()
+
+        a1, a2 = tmp_path / "pull1" / "a.bson", tmp_path / "pull2" / "a.bson"
+        assert a1.stat().st_ino == a2.stat().st_ino
+        assert (tmp_path / "pull2" / "b.bson").read_bytes() == b"bb"
+        assert (tmp_path / "pull1" / "b.bson").read_bytes() == b"b"
+        assert len(list(cache.iterdir())) == 2
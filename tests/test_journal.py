@@ -0,0 +1,33 @@
+from recycle.journal import Journal
+
+
+class TestJournal:
+    def test_resume(self, tmp_path):
+
+        path = tmp_path / "journal.jsonl"
+        run = dict(command="mongo", source="mongodb://host/db", sink="gs://bucket")
+
+        journal = Journal(path, run=run)
+        journal.mark("dumped")
+        journal.mark("transformed", "db/users")
+        journal.mark("restoring", "db/users", offset=1024)
+
+        resumed = Journal(path, run=run, resume=True)
+        assert resumed.done("dumped")
+        assert resumed.done("transformed", "db/users")
+        assert not resumed.done("transformed", "db/orders")
+        assert resumed.get("restoring", "db/users")["offset"] == 1024
+        assert "mongodb://" not in path.read_text()
+
+        resumed.clear()
+        assert not path.exists()
+
+    def test_restart(self, tmp_path):
+
+        path = tmp_path / "journal.jsonl"
+
+        journal = Journal(path, run=dict(source="a"))
+        journal.mark("dumped")
+
+        assert not Journal(path, run=dict(source="b"), resume=True).done("dumped")
+        assert not Journal(path, run=dict(source="b"), resume=False).done("dumped")
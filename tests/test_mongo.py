@@ -1,14 +1,29 @@
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
+import io
+import json
 import logging
 from pathlib import Path
+import re
 import shutil
 
 import bson
+from bson import json_util
+from bson.int64 import Int64
+import dataconf
+from dateutil.relativedelta import relativedelta
 from dictdiffer import diff
+import pymongo
+import pytest
+from recycle import config
+from recycle.journal import Journal
 from recycle.providers import mongo
 from tests.conftest import mongo_test1
+from tests.conftest import mongo_test2
+from tests.utils import read_bson
 from tests.utils import seed_mongo
+from tests.utils import write_bson
 
 n = 10
 
@@ -64,6 +79,33 @@ class TestMongo:
         after = list(db["profiles"].find())
         assert before == after
 
+    def test_restore_py_resume(self, clean_mongo, tmp_path):
+        db = mongo.get_database(mongo_test1)
+        docs = [dict(_id=i, name=str(i)) for i in range(30)]
+        file = tmp_path / "test1" / "users.bson.gz"
+        write_bson(file, docs)
+
+        # the previous run acknowledged 10 documents and was restoring 5 more
+        db["users"].insert_many(docs[:15])
+        journal = Journal(tmp_path / "journal.jsonl")
+        offset = sum(len(bson.encode(d)) for d in docs[:10])
+        journal.mark("restoring", "test1/users", offset=offset)
+
+        mongo.restore_py_collection(
+            mongo_test1, "users", str(file), batch_bytes=64, journal=journal
+        )
+        assert sorted(d["_id"] for d in db["users"].find()) == list(range(30))
+        assert journal.done("restored", "test1/users")
+
+        # without an offset to resume from, duplicates are errors
+        with pytest.raises(pymongo.errors.BulkWriteError):
+            mongo.restore_py_collection(
+                mongo_test1,
+                "users",
+                str(file),
+                journal=Journal(tmp_path / "other.jsonl"),
+            )
+
     def test_dump_cli_filter_restore_cli(self, clean_mongo):
         db = mongo.get_database(mongo_test1)
 
@@ -152,3 +194,379 @@ class TestMongo:
 
         mongo.restore_cli(mongo_test1, folder=path.absolute())
         assert db[collection].count_documents({}) == 0
+
+    def test_transform_parallel(self, tmp_path):
+        ops = dataconf.loads(
+            """
+            transforms {
+                test1 {
+                    small {
+                        anonymize {
+                            name = str
+                        }
+                    }
+                    large {
+                        keep = 5d
+                    }
+                    dropped {
+                        drop = true
+                    }
+                }
+            }
+            """,
+            config.Ops,
+        )
+
+        now = datetime.now(tz=timezone.utc)
+        sizes = dict(small=5, large=50, dropped=1, untouched=5)
+        for collection, size in sizes.items():
+            write_bson(
+                tmp_path / "test1" / f"{collection}.bson.gz",
+                [
+                    dict(
+                        _id=bson.ObjectId.from_datetime(now - timedelta(days=i)),
+                        name=str(i),
+                    )
+                    for i in range(size)
+                ],
+            )
+
+        results = mongo.transform(ops, tmp_path, n_jobs=2)
+        assert [r["collection"] for r in results] == ["large", "small", "dropped"]
+        assert (results[0]["read"], results[0]["written"]) == (50, 5)
+        assert (results[1]["read"], results[1]["written"]) == (5, 5)
+
+        assert not (tmp_path / "test1" / "dropped.bson.gz").exists()
+        assert len(read_bson(tmp_path / "test1" / "large.bson.gz")) == 5
+        assert len(read_bson(tmp_path / "test1" / "untouched.bson.gz")) == 5
+        for i, doc in enumerate(read_bson(tmp_path / "test1" / "small.bson.gz")):
+            assert doc["name"] != str(i)
+
+    def test_compile_plan(self):
+        rules = config.Transform(
+            keep=relativedelta(days=5), drop=None, anonymize=dict(name="str")
+        )
+        now = datetime.now(tz=timezone.utc)
+        plan = mongo.compile_plan(rules, now)
+
+        old = bson.ObjectId.from_datetime(now - timedelta(days=10))
+        recent = bson.ObjectId.from_datetime(now - timedelta(days=1))
+
+        assert not plan(dict(_id=old, name="old"))
+        assert plan(dict(_id=old, name="old", email="dev@smood.ch"))
+
+        doc = dict(_id=recent, name="recent")
+        assert plan(doc)
+        assert doc["name"] != "recent"
+
+        rules.drop = True
+        assert mongo.compile_plan(rules, now) is None
+
+    def test_filtr_json(self, tmp_path):
+        docs = [
+            dict(_id=bson.ObjectId(), value=i, text='a, ]} " [{') for i in range(100)
+        ]
+
+        array_file = tmp_path / "array.json"
+        array_file.write_text(
+            "[\n" + ",\n".join(mongo.json_dumps(d) for d in docs) + "\n]"
+        )
+        with open(array_file) as inp:
+            assert list(mongo.json_array_iter(inp, chunk_size=7)) == docs
+
+        lines_file = tmp_path / "lines.json"
+        lines_file.write_text("".join(mongo.json_dumps(d) + "\n" for d in docs))
+
+        def keep_even(doc):
+            return doc["value"] % 2 == 0
+
+        assert mongo.filtr(array_file, keep_even, jsonarray=True) == (100, 50)
+        assert mongo.filtr(lines_file, keep_even, jsonarray=True, ndjson=True) == (
+            100,
+            50,
+        )
+
+        with open(array_file) as inp:
+            assert list(mongo.json_array_iter(inp)) == docs[::2]
+        with open(lines_file) as inp:
+            assert list(mongo.json_lines_iter(inp)) == docs[::2]
+
+    def test_id_ranges(self, clean_mongo):
+        seed_mongo(mongo_test1, "profiles", n)
+        collection = mongo.get_database(mongo_test1)["profiles"]
+
+        assert mongo.id_ranges(collection, 1) == [{}]
+        ranges = mongo.id_ranges(collection, 4)
+        assert 1 < len(ranges) <= 4
+        assert "$gte" not in ranges[0] and "$lt" not in ranges[-1]
+
+        counts = [
+            collection.count_documents({"_id": json_util.loads(json.dumps(bound))})
+            for bound in ranges
+        ]
+        assert sum(counts) == n
+
+    def test_join_exports(self, tmp_path):
+        docs = [dict(_id=bson.ObjectId(), value=i) for i in range(10)]
+        parts = []
+        for i in range(3):
+            parts.append(tmp_path / f"data.json.part-{i}")
+            parts[-1].write_text(
+                "".join(mongo.json_dumps(d) + "\n" for d in docs[i * 4 : i * 4 + 4])
+            )
+
+        mongo.join_exports(parts, tmp_path / "data.json", jsonarray=True)
+        with open(tmp_path / "data.json") as inp:
+            assert list(mongo.json_array_iter(inp)) == docs
+        assert not any(part.exists() for part in parts)
+
+    def test_plan_raw(self):
+        now = datetime.now(tz=timezone.utc)
+        old = bson.ObjectId.from_datetime(now - timedelta(days=10))
+        recent = bson.ObjectId.from_datetime(now - timedelta(days=1))
+        docs = [
+            dict(_id=old, name="old"),
+            dict(_id=recent, name="recent", nested=dict(email="x@smood.ch")),
+            dict(name="first", _id=recent, bin=bson.Binary(b"\x00" * 5)),
+            dict(_id=old, email="dev@smood.ch", name="preserved"),
+            dict(_id=recent, email=None, tags=["a", "b"], score=1.5),
+        ]
+
+        keep = config.Transform(keep=relativedelta(days=5), drop=None)
+        plan = mongo.compile_plan(keep, now)
+        raw = [plan.raw(bson.encode(d)) for d in docs]
+        assert raw == [bson.encode(d) if plan(dict(d)) else None for d in docs]
+        assert raw[1] is not None and raw[0] is None
+
+        anonymize = config.Transform(keep=None, drop=None, anonymize=dict(name="str"))
+        plan = mongo.compile_plan(anonymize, now)
+        raw = [bson.decode(plan.raw(bson.encode(d))) for d in docs]
+        assert raw[3] == docs[3]
+        for before, after in zip(docs[:3], raw[:3]):
+            assert after["name"] != before["name"]
+            assert after["_id"] == before["_id"]
+
+        # ids without a date are left out by keep, as by the pushed down query
+        plan = mongo.compile_plan(keep, now)
+        for doc in [dict(_id="custom"), dict(_id=1, name="x"), dict(name="no id")]:
+            assert plan.raw(bson.encode(doc)) is None
+            assert not plan(doc)
+        preserved = dict(_id="custom", email="dev@smood.ch")
+        assert plan.raw(bson.encode(preserved)) == bson.encode(preserved)
+        assert plan(preserved)
+
+    def test_keep_queries(self):
+        ops = dataconf.loads(
+            """
+            transforms {
+                test1 {
+                    events {
+                        keep = 5d
+                    }
+                    dropped {
+                        keep = 5d
+                        drop = true
+                    }
+                    profiles {
+                        anonymize {
+                            name = str
+                        }
+                    }
+                }
+            }
+            """,
+            config.Ops,
+        )
+        now = datetime(2021, 7, 10, tzinfo=timezone.utc)
+
+        queries = mongo.keep_queries(ops, "test1", now=now)
+        assert list(queries.keys()) == ["events"]
+
+        keep, preserved = bson.json_util.loads(queries["events"])["$or"]
+        lower = keep["_id"]["$gte"]
+        assert lower.generation_time == datetime(2021, 7, 5, tzinfo=timezone.utc)
+        assert re.search(preserved["email"].pattern, "dev@jamtech.ch")
+        assert not re.search(preserved["email"].pattern, "dev@jamtechxch")
+        assert " " not in queries["events"]
+        assert mongo.keep_queries(ops, "test2", now=now) == {}
+
+    def test_keep_queries_watermarks(self):
+        ops = dataconf.loads(
+            """
+            transforms {
+                test1 {
+                    events {
+                        keep = 5d
+                    }
+                }
+            }
+            """,
+            config.Ops,
+        )
+        now = datetime(2021, 7, 10, tzinfo=timezone.utc)
+        since = str(bson.ObjectId.from_datetime(now - timedelta(days=1)))
+        until = str(bson.ObjectId.from_datetime(now))
+        watermarks = dict(events=(since, until), profiles=(None, until))
+
+        queries = mongo.keep_queries(ops, "test1", now=now, watermarks=watermarks)
+        events = bson.json_util.loads(queries["events"])
+        assert sorted(events.keys()) == ["$or", "_id"]
+        events = events["_id"]
+        assert sorted(events.keys()) == ["$gt", "$lte"]
+        assert str(events["$gt"]) == since
+        assert list(bson.json_util.loads(queries["profiles"])["_id"]) == ["$lte"]
+        assert mongo.keep_queries(None, "test1", watermarks=dict(e=(None, None))) == {}
+
+    def test_merge_layers(self, tmp_path):
+        snapshot = tmp_path / "snapshot"
+        docs = [dict(_id=bson.ObjectId(), n=i) for i in range(6)]
+
+        write_bson(snapshot / "base" / "events.bson.gz", docs[:2])
+        write_bson(snapshot / "base" / "profiles.bson.gz", docs[:2])
+        watermarks = dict(events=(None, str(docs[1]["_id"])), profiles=(None, None))
+        mongo.write_layer(snapshot, "base", watermarks, "gzip")
+
+        write_bson(snapshot / "delta-1" / "events.bson.gz", docs[2:4])
+        write_bson(snapshot / "delta-1" / "profiles.bson.gz", docs[:3])
+        watermarks = dict(
+            events=(str(docs[1]["_id"]), str(docs[3]["_id"])), profiles=(None, None)
+        )
+        manifest = mongo.write_layer(snapshot, "delta-1", watermarks, "gzip")
+        assert [layer["collections"] for layer in manifest["layers"]] == [
+            dict(events="full", profiles="full"),
+            dict(events="delta", profiles="full"),
+        ]
+        assert manifest["watermarks"] == dict(events=str(docs[3]["_id"]))
+
+        write_bson(snapshot / "delta-2" / "events.bson.gz", docs[4:])
+        watermarks = dict(events=(str(docs[3]["_id"]), str(docs[5]["_id"])))
+        mongo.write_layer(snapshot, "delta-2", watermarks, "gzip")
+
+        mongo.merge_layers(tmp_path)
+        assert read_bson(snapshot / "events.bson.gz") == docs
+        assert read_bson(snapshot / "profiles.bson.gz") == docs[:3]
+        assert sorted(p.name for p in snapshot.iterdir()) == [
+            "events.bson.gz",
+            "manifest.json",
+            "profiles.bson.gz",
+        ]
+
+    def test_change_op(self):
+        now = datetime(2021, 7, 10, tzinfo=timezone.utc)
+        plans = dict(
+            users=mongo.compile_plan(
+                config.Transform(
+                    keep=relativedelta(days=5), drop=None, anonymize=dict(name="str")
+                ),
+                now,
+            ),
+            logs=None,
+        )
+        recent = bson.ObjectId.from_datetime(now - timedelta(days=1))
+        old = bson.ObjectId.from_datetime(now - timedelta(days=10))
+
+        def event(kind, coll, _id, doc=None):
+            return dict(
+                operationType=kind,
+                ns=dict(db="test1", coll=coll),
+                documentKey=dict(_id=_id),
+                fullDocument=doc,
+            )
+
+        coll, key, op = mongo.change_op(
+            event("update", "users", recent, dict(_id=recent, name="john")), plans
+        )
+        assert coll == "users"
+        assert key == bson.encode(dict(_id=recent))
+        assert isinstance(op, pymongo.ReplaceOne)
+        assert op._doc["name"] != "john"
+
+        _, _, op = mongo.change_op(event("delete", "users", recent), plans)
+        assert isinstance(op, pymongo.DeleteOne)
+
+        _, _, op = mongo.change_op(
+            event("insert", "events", old, dict(_id=old, name="john")), plans
+        )
+        assert op._doc["name"] == "john"
+
+        assert (
+            mongo.change_op(event("insert", "users", old, dict(_id=old)), plans) is None
+        )
+        assert (
+            mongo.change_op(event("insert", "logs", recent, dict(_id=recent)), plans)
+            is None
+        )
+        assert mongo.change_op(event("update", "users", recent), plans) is None
+        assert mongo.change_op(dict(operationType="invalidate"), plans) is None
+
+    def test_resume_token_path(self, tmp_path):
+        path = mongo.resume_token_path(mongo_test1, mongo_test2, "users")
+        assert path == mongo.resume_token_path(mongo_test1, mongo_test2, "users")
+        assert path != mongo.resume_token_path(mongo_test1, mongo_test2)
+        assert path != mongo.resume_token_path(mongo_test1, mongo_test1, "users")
+
+        path = tmp_path / path
+        assert mongo.read_resume_token(path) is None
+        mongo.write_resume_token({"_data": "826"}, path)
+        assert mongo.read_resume_token(path) == {"_data": "826"}
+
+    def test_crc64(self):
+        assert mongo.crc64(0, b"123456789") == 0x995DC9BBDF1939FA
+        assert mongo.crc64(mongo.crc64(0, b"1234"), b"56789") == 0x995DC9BBDF1939FA
+
+    def test_transform_archive(self):
+        now = datetime.now(tz=timezone.utc)
+        old = [dict(_id=bson.ObjectId.from_datetime(now - timedelta(days=10)))]
+        recent = [dict(_id=bson.ObjectId(), name=str(i)) for i in range(3)]
+
+        def namespace(collection, docs):
+            ns = dict(db="test1", collection=collection)
+            body = b"".join(bson.encode(d) for d in docs)
+            return (
+                bson.encode(dict(ns, EOF=False, CRC=Int64(0)))
+                + body
+                + mongo.archive_terminator
+                + bson.encode(
+                    dict(ns, EOF=True, CRC=mongo.signed_int64(mongo.crc64(0, body)))
+                )
+                + mongo.archive_terminator
+            )
+
+        archive = (
+            mongo.archive_magic
+            + bson.encode(dict(version="0.1", concurrent_collections=1))
+            + bson.encode(dict(db="test1", collection="events", metadata="{}"))
+            + mongo.archive_terminator
+            + namespace("events", old + recent)
+            + namespace("untouched", old)
+        )
+
+        ops = dataconf.loads(
+            "transforms { test1 { events { keep = 5d, anonymize { name = str } } } }",
+            config.Ops,
+        )
+        out = io.BytesIO()
+        mongo.transform_archive(io.BytesIO(archive), out, ops)
+
+        blocks = list(mongo.archive_blocks(io.BytesIO(out.getvalue()[4:])))
+        assert blocks[:3] == list(mongo.archive_blocks(io.BytesIO(archive[4:])))[:3]
+
+        docs = [bson.decode(b) for b in blocks[4:7]]
+        assert [d["_id"] for d in docs] == [d["_id"] for d in recent]
+        assert all(a["name"] != b["name"] for a, b in zip(docs, recent))
+
+        eof = bson.decode(blocks[8])
+        assert eof["EOF"]
+        assert eof["CRC"] == mongo.signed_int64(mongo.crc64(0, b"".join(blocks[4:7])))
+        assert out.getvalue().endswith(namespace("untouched", old))
+
+    def test_batch_bytes_itr(self):
+        docs = [b"x" * size for size in [10, 20, 30, 5, 5, 100, 1]]
+        batches = list(mongo.batch_bytes_itr(iter(docs), 30))
+        assert [[len(d) for d in b] for b in batches] == [
+            [10, 20],
+            [30],
+            [5, 5, 100],
+            [1],
+        ]
+        assert len(list(mongo.batch_bytes_itr(iter(docs), 1000, 3))) == 3
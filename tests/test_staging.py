@@ -0,0 +1,33 @@
+import errno
+import os
+
+from recycle import staging
+
+
+class TestStaging:
+    def test_move_tree(self, tmp_path):
+        source = tmp_path / "dump" / "test1"
+        (source / "base").mkdir(parents=True)
+        (source / "base" / "users.bson").write_bytes(b"users")
+        (source / "manifest.json").write_text("{}")
+
+        staging.move_tree(source, tmp_path / "sink")
+
+        assert (tmp_path / "sink" / "base" / "users.bson").read_bytes() == b"users"
+        assert (tmp_path / "sink" / "manifest.json").read_text() == "{}"
+        assert not source.exists() or not any(source.iterdir())
+
+    def test_move_file_across_devices(self, tmp_path, monkeypatch):
+        (tmp_path / "users.bson").write_bytes(b"users")
+        replace = os.replace
+
+        def cross_device(source, sink):
+            if not str(source).endswith(".tmp"):
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            replace(source, sink)
+
+        monkeypatch.setattr(os, "replace", cross_device)
+        staging.move_file(tmp_path / "users.bson", tmp_path / "sink" / "users.bson")
+
+        assert (tmp_path / "sink" / "users.bson").read_bytes() == b"users"
+        assert not (tmp_path / "users.bson").exists()
@@ -1,4 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import pytest
+from recycle import config
 from recycle.utils import fake_like_gen
+from recycle.utils import fake_map_gen
+from recycle.utils import fake_mapping
+from recycle.utils import fake_pool
+from recycle.utils import FakeMapping
+from recycle.utils import FakePool
+from recycle.utils import flush_mappings
+from recycle.utils import get_mapping
+from recycle.utils import prefetch
+from recycle.utils import shell
+from recycle.utils import shell_all
 
 
 class TestUtils:
@@ -11,3 +26,123 @@ class TestUtils:
         run2 = gen()
         assert list(run1.keys()) == ["field"]
         assert run1 != run2
+
+    def test_fake_pool(self):
+
+        anonymize = dict(email="email", name="firstname", phones=["phone"])
+        pool1 = FakePool(size=100, seed=42)
+        pool2 = FakePool(size=100, seed=42)
+        gen1 = fake_like_gen(anonymize, faker=pool1)
+        gen2 = fake_like_gen(anonymize, faker=pool2)
+
+        runs1 = [gen1() for _ in range(1000)]
+        runs2 = [gen2() for _ in range(1000)]
+        assert len(pool1.pools["first_name"]) == 100
+        assert [r["name"] for r in runs1] == [r["name"] for r in runs2]
+        assert [r["phones"] for r in runs1] == [r["phones"] for r in runs2]
+
+        emails = [r["email"] for r in runs1 + runs2]
+        assert len(set(emails)) == len(emails)
+
+    def test_fake_mapping(self, tmp_path):
+
+        anonymize = dict(email="email", phones=["phone"], missing="str")
+        store = str(tmp_path / "mapping.db")
+        gen1 = fake_map_gen(anonymize, FakeMapping("secret", store=store))
+        gen2 = fake_map_gen(anonymize, FakeMapping("secret", faker=FakePool(size=10)))
+        gen3 = fake_map_gen(anonymize, FakeMapping("secret", store=store))
+
+        alice = dict(email="alice@example.com", phones=["+41 00 000 00 00"])
+        bob = dict(email="bob@example.com", phones=["+41 11 111 11 11"])
+
+        run1 = gen1(alice)
+        assert run1 == gen1(dict(alice))
+        assert run1 != gen1(bob)
+        assert run1["missing"] is None
+        assert run1["email"] != alice["email"]
+
+        # values come from the shared store, not from the pool of gen2
+        flush_mappings()
+        assert gen2(alice) != run1
+        assert gen3(alice) == run1
+
+    def test_fake_mapping_threads(self, tmp_path):
+
+        store = str(tmp_path / "mapping.db")
+        mapping = FakeMapping("secret", store=store, cache_size=10, batch_size=50)
+        values = [f"name {i}" for i in range(500)]
+
+        # the tables of a stream are copied by threads sharing the mapping
+        with ThreadPoolExecutor(4) as pool:
+            runs = list(
+                pool.map(lambda _: [mapping("str", v) for v in values], range(4))
+            )
+        mapping.flush()
+
+        assert all(run == runs[0] for run in runs)
+        assert [FakeMapping("secret", store=store)("str", v) for v in values] == runs[0]
+
+    def test_get_mapping_pool_seed(self):
+
+        pool = config.Pool(size=10)
+        values = [f"name {i}" for i in range(20)]
+
+        def run(key):
+            # every worker process builds its own pool
+            fake_pool.cache_clear()
+            fake_mapping.cache_clear()
+            mapping = get_mapping(config.Mapping(key=key), pool)
+            return [mapping("str", v) for v in values]
+
+        assert run("secret") == run("secret")
+        assert run("secret") != run("other")
+
+    def test_prefetch(self):
+
+        assert list(prefetch(iter(range(100)), 3)) == list(range(100))
+
+        def failing():
+            yield 1
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            list(prefetch(failing()))
+
+        closed = []
+
+        def reading():
+            try:
+                yield from range(100)
+            finally:
+                closed.append(True)
+
+        # a consumer failing midway stops the producer and closes the source
+        with pytest.raises(ValueError):
+            for i in prefetch(reading(), 3):
+                if i == 10:
+                    raise ValueError("write failed")
+        assert closed == [True]
+
+    def test_shell(self):
+
+        assert shell(["sh", "-c", "echo a; echo b"]) == ["a", "b"]
+        assert shell(["sh", "-c", "echo '{\"a\":'; echo '1}'"], json=True) == '{"a":1}'
+
+        with pytest.raises(AssertionError):
+            shell(["sh", "-c", "exit 1"])
+
+    def test_shell_all(self):
+
+        start = time()
+        ret = shell_all([["sh", "-c", f"sleep 0.5; echo {i}"] for i in range(4)])
+        assert ret == [["0"], ["1"], ["2"], ["3"]]
+        assert time() - start < 1.5
+
+        start = time()
+        shell_all([["sleep", "0.3"]] * 4, limit=2)
+        assert time() - start >= 0.6
+
+        start = time()
+        with pytest.raises(AssertionError):
+            shell_all([["sleep", "10"], ["sh", "-c", "sleep 0.2; exit 1"]])
+        assert time() - start < 5
@@ -1,3 +1,7 @@
+import gzip
+from pathlib import Path
+
+import bson
 from faker import Faker
 from recycle.providers import mongo
 from recycle.providers import postgres
@@ -25,7 +29,7 @@ def seed_mongo(uri, collection, n):
     assert db[collection].count_documents({}) == n
 
 
-def seed_postgres(uri, table, n):
+def seed_postgres(uri, table, n, schema=None):
     records = [
         {
             "string": faker.pystr(),
@@ -51,6 +55,7 @@ def seed_postgres(uri, table, n):
         Column("boolean", Boolean()),
         Column("text", Text()),
         Column("json", JSON(100)),
+        schema=schema,
     )
 
     users.drop(checkfirst=True)
@@ -59,3 +64,15 @@ def seed_postgres(uri, table, n):
 
     assert next(session.execute(f"SELECT COUNT(*) FROM {table}"))[0] == n
     session.close()
+
+
+def write_bson(file, docs):
+    Path(file).parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(file, "wb") as out:
+        for doc in docs:
+            out.write(bson.encode(doc))
+
+
+def read_bson(file):
+    with gzip.open(file, "rb") as inp:
+        return list(bson.decode_file_iter(inp))